@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class AutoRelatedConfig(AppConfig):
+    name = 'auto_related'
+    verbose_name = 'Auto Related'
+
+    def ready(self):
+        from .registry import registry
+        # relation graph of models is built once here so that requests do not introspect _meta
+        registry.build()
@@ -0,0 +1,113 @@
+from asgiref.sync import sync_to_async
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from django.views import View
+
+from .cache import fill_relations
+from .mixin import StreamingViewMixin, ViewMixin
+from .queryset import batched_prefetch_related_objects, share_instances
+
+try:
+    # django>=5.0
+    from django.db.models import aprefetch_related_objects
+except ImportError:
+    async def aprefetch_related_objects(model_instances, *related_lookups):
+        return await sync_to_async(prefetch_related_objects)(model_instances, *related_lookups)
+
+
+async def aiterate_in_chunks(queryset, chunk_size):
+    """
+    async version of iterate_in_chunks. Queryset is iterated with aiterator() and prefetch lookups of
+    the queryset are applied to each chunk with aprefetch_related_objects.
+    """
+    lookups=queryset._prefetch_related_lookups
+    batch_size=getattr(queryset, 'prefetch_batch_size', None)
+    async def prefetch(chunk):
+        if batch_size is not None:
+            await sync_to_async(batched_prefetch_related_objects)(chunk, lookups, batch_size)
+        else:
+            await aprefetch_related_objects(chunk, *lookups)
+
+    fill_paths=getattr(queryset, 'fill_paths', ())
+    identity_map=getattr(queryset, 'identity_map', False)
+    chunk=[]
+    async for obj in queryset.prefetch_related(None).aiterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk)==chunk_size:
+            await prefetch(chunk)
+            if fill_paths:
+                await sync_to_async(fill_relations)(chunk, fill_paths)
+            if identity_map:
+                share_instances(chunk)
+            yield chunk
+            chunk=[]
+    if chunk:
+        await prefetch(chunk)
+        if fill_paths:
+            await sync_to_async(fill_relations)(chunk, fill_paths)
+        if identity_map:
+            share_instances(chunk)
+        yield chunk
+
+
+class AsyncViewMixin(StreamingViewMixin, ViewMixin):
+    """
+    Async counterpart of ViewMixin for async views. Queryset is built with the traced plan just like ViewMixin
+    and evaluated with django's async orm api. Serialization is done chunk by chunk and it does not touch the
+    database as long as the plan covers the serializer.
+    """
+    async def alist(self, request, *args, **kwargs):
+        queryset=self.get_queryset()
+        return StreamingHttpResponse(self.astream(queryset), content_type='application/json')
+
+
+    async def astream(self, queryset):
+        yield '['
+        separator=''
+        async for chunk in aiterate_in_chunks(queryset, self.stream_chunk_size):
+            for item in self.get_serializer(chunk, many=True).data:
+                yield separator+self.encode(item)
+                separator=','
+        yield ']'
+
+
+    async def aget_object(self, **filters):
+        """returns the instance matching filters from the traced queryset with its relations prefetched"""
+        return await self.get_queryset().aget(**filters)
+
+
+class AsyncGenericView(View):
+    """
+    Minimal generic view for async list endpoints. Authentication, permissions, filtering and pagination of
+    rest framework are not applied since rest framework views are synchronous.
+    """
+    queryset=None
+    serializer_class=None
+
+    def get_queryset(self):
+        return self.queryset.all()
+
+
+    def get_serializer_class(self):
+        return self.serializer_class
+
+
+    def get_serializer_context(self):
+        return {'request': self.request, 'view': self}
+
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('context', self.get_serializer_context())
+        return self.get_serializer_class()(*args, **kwargs)
+
+
+class AsyncListView(AsyncViewMixin, AsyncGenericView):
+    """
+    Async list view that streams a json array of the traced queryset;
+
+        class CourseList(AsyncListView):
+            serializer_class=CourseSerializer
+            queryset=Course.objects.all()
+    """
+    async def get(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
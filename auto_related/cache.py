@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from copy import copy
+from threading import Lock
+from time import monotonic
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models.signals import post_delete, post_save
+
+from .registry import registry
+
+
+class LocalRelationCache:
+    """
+    Process local cache of model instances keyed on (model, pk). Least recently used instances are dropped when there
+    are more than maxsize of them and instances older than ttl seconds are not returned if ttl is given. Instances are
+    copied when they are stored and returned so that a request cannot change the instances of another one.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self._items=OrderedDict()
+        self._lock=Lock()
+
+
+    def get_many(self, model, pks):
+        """returns {pk: instance} of the cached ones of pks"""
+        now=monotonic()
+        res={}
+        with self._lock:
+            for pk in pks:
+                key=(model, pk)
+                item=self._items.get(key)
+                if item is None:
+                    continue
+                instance, expires=item
+                if expires is not None and expires<now:
+                    del self._items[key]
+                    continue
+                self._items.move_to_end(key)
+                res[pk]=copy(instance)
+        return res
+
+
+    def set_many(self, model, instances):
+        expires=monotonic()+self.ttl if self.ttl is not None else None
+        with self._lock:
+            for instance in instances:
+                self._items[(model, instance.pk)]=(copy(instance), expires)
+                self._items.move_to_end((model, instance.pk))
+            while len(self._items)>self.maxsize:
+                self._items.popitem(last=False)
+
+
+    def delete(self, model, pk):
+        with self._lock:
+            self._items.pop((model, pk), None)
+
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class DjangoRelationCache:
+    """
+    Relation cache backed by django's cache framework, so that it could be shared by processes through memcached or redis.
+    Instances are pickled by the cache backend. It has no clear() since clearing the cache alias would drop entries of
+    others as well, instances expire after timeout or are deleted when they change.
+    """
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT, key_prefix='auto_related'):
+        self.alias=alias
+        self.timeout=timeout
+        self.key_prefix=key_prefix
+
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+
+    def make_key(self, model, pk):
+        return '{}:{}:{}'.format(self.key_prefix, model._meta.label_lower, pk)
+
+
+    def get_many(self, model, pks):
+        keys={self.make_key(model, pk): pk for pk in pks}
+        return {keys[key]: instance for key, instance in self.cache.get_many(list(keys)).items()}
+
+
+    def set_many(self, model, instances):
+        self.cache.set_many({self.make_key(model, instance.pk): instance for instance in instances}, timeout=self.timeout)
+
+
+    def delete(self, model, pk):
+        self.cache.delete(self.make_key(model, pk))
+
+
+class RelationCaches:
+    """
+    Models whose instances are read from a relation cache instead of being joined. Foreign keys to them are dropped from
+    select_related of the plans and filled from the cache after the instances that point them are fetched. Cached
+    instances are invalidated when they are saved or deleted. It is meant for small and rarely changing lookup tables;
+
+        relation_caches.register(Country)
+        relation_caches.register(Status, LocalRelationCache(ttl=60))
+        relation_caches.register(Category, DjangoRelationCache())
+    """
+    def __init__(self):
+        self._caches={}
+
+
+    def register(self, model, cache=None):
+        cache=cache if cache is not None else LocalRelationCache()
+        self._caches[model]=cache
+        post_save.connect(self.invalidate, sender=model, weak=False, dispatch_uid=('auto_related', model))
+        post_delete.connect(self.invalidate, sender=model, weak=False, dispatch_uid=('auto_related', model))
+        self.invalidate_plans()
+        return cache
+
+
+    def unregister(self, model):
+        self._caches.pop(model, None)
+        post_save.disconnect(sender=model, dispatch_uid=('auto_related', model))
+        post_delete.disconnect(sender=model, dispatch_uid=('auto_related', model))
+        self.invalidate_plans()
+
+
+    def invalidate(self, sender, instance, **kwargs):
+        cache=self._caches.get(sender)
+        if cache is not None:
+            cache.delete(sender, instance.pk)
+
+
+    @staticmethod
+    def invalidate_plans():
+        # plans built before a model is registered would still join it
+        from .plan import plan_cache
+        plan_cache.invalidate()
+
+
+    def get(self, model):
+        return self._caches.get(model)
+
+
+    def __contains__(self, model):
+        return model in self._caches
+
+
+    def __bool__(self):
+        return bool(self._caches)
+
+
+relation_caches=RelationCaches()
+
+
+def fill_relations(instances, paths, caches=None):
+    """
+    Sets cached related instances of the foreign keys at paths like 'status' or 'child__country' on instances. Hops
+    before the last one should be joined already. Instances that are not cached are fetched in one query per path and
+    cached. Instances pointing the same pk share the same related instance.
+    """
+    caches=caches if caches is not None else relation_caches
+    for path in paths:
+        *joined, accessor=path.split('__')
+        targets=list(instances)
+        for name in joined:
+            if not targets:
+                break
+            field=registry.edge(type(targets[0]), name).field
+            targets=[each for each in (field.get_cached_value(obj, None) for obj in targets) if each is not None]
+        if not targets:
+            continue
+
+        field=registry.edge(type(targets[0]), accessor).field
+        model=field.related_model
+        cache=caches.get(model)
+        if cache is None:
+            continue
+        pks={getattr(obj, field.attname) for obj in targets}-{None}
+        related=cache.get_many(model, pks)
+        missing=pks-set(related)
+        if missing:
+            fetched=list(model._base_manager.filter(pk__in=missing))
+            cache.set_many(model, fetched)
+            related.update((instance.pk, instance) for instance in fetched)
+        for obj in targets:
+            field.set_cached_value(obj, related.get(getattr(obj, field.attname)))
@@ -0,0 +1,244 @@
+import re
+from contextlib import ExitStack
+
+from django.apps import apps
+from django.db import connections
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+from .plan import plan_cache
+from .registry import registry
+from .tracer import Tracer
+from .utils import learned_sources
+
+import logging
+logger = logging.getLogger("django-auto-related")
+
+
+class NPlusOneError(Exception):
+    """raised by NPlusOneDetector in 'raise' mode when a query is executed while serializing"""
+    def __init__(self, lazy_load):
+        self.lazy_load=lazy_load
+        super().__init__(str(lazy_load))
+
+
+# table that a query selects from
+FROM_TABLE=re.compile(r'\bFROM\s+[`"\[]?(\w+)')
+
+
+class LazyLoad:
+    """
+    A query executed while a field of a serializer was being serialized, which means that the relation it
+    accesses is not prefetched. relation is None if the query cannot be attributed to a relation.
+    """
+    def __init__(self, serializer_class, field_path, source, relation, sql):
+        self.serializer_class=serializer_class
+        self.field_path=field_path
+        self.source=source
+        self.relation=relation
+        self.sql=sql
+
+
+    def __str__(self):
+        return 'Query executed while serializing {} of {} (source: {}, relation: {}): {}'.format(
+            self.field_path, self.serializer_class.__name__, self.source or '*', self.relation or 'unknown', self.sql)
+
+
+class NPlusOneDetector:
+    """
+    Catches queries that are executed while the fields of an instrumented serializer are serialized. Those are lazy
+    loads that the tracer did not predict, for example relations accessed in a SerializerMethodField without sources
+    or in a property. Queries executed before serialization starts, like evaluating the queryset itself and its
+    prefetches, are not reported.
+
+    A query of a field whose source is a relation is attributed to that relation. A query of a method or a property
+    is attributed to the shortest path of relations from the object the field reads to the model of the table that
+    the query selects from, if there is only one such path.
+
+    mode could be;
+        'warn': logs a warning for each lazy load
+        'raise': raises NPlusOneError, useful in tests
+        'learn': adds sources of the lazy loads to learned sources of the serializer so that next plans prefetch them
+
+        with NPlusOneDetector(mode='raise') as detector:
+            serializer=detector.instrument(SomeSerializer(queryset, many=True))
+            serializer.data
+    """
+    MODES=('warn', 'raise', 'learn')
+
+    def __init__(self, mode='warn', using=None, store=learned_sources):
+        if mode not in self.MODES:
+            raise ValueError('mode should be one of {}'.format(', '.join(self.MODES)))
+        self.mode=mode
+        self.using=using
+        self.store=store
+        self.lazy_loads=[]
+        self.serializer=None
+        # fields that are being serialized at the moment
+        self._stack=[]
+        self._stack_context=None
+
+
+    def instrument(self, serializer):
+        """wraps fields of the serializer and its nested serializers to know which field is being serialized"""
+        root=serializer.child if isinstance(serializer, ListSerializer) else serializer
+        if self.serializer is None:
+            self.serializer=root
+        self._instrument(root)
+        return serializer
+
+
+    def _instrument(self, serializer):
+        try:
+            fields=serializer.fields
+        except AttributeError:
+            return
+        for field in fields.values():
+            self._wrap(field)
+            if isinstance(field, ListSerializer):
+                self._instrument(field.child)
+            elif isinstance(field, BaseSerializer):
+                self._instrument(field)
+
+
+    def _wrap(self, field):
+        for name in ('get_attribute', 'to_representation'):
+            original=getattr(field, name)
+            def wrapped(*args, _original=original, **kwargs):
+                self._stack.append(field)
+                try:
+                    return _original(*args, **kwargs)
+                finally:
+                    self._stack.pop()
+            setattr(field, name, wrapped)
+
+
+    def __call__(self, execute, sql, params, many, context):
+        if self._stack:
+            self.report(sql)
+        return execute(sql, params, many, context)
+
+
+    def report(self, sql):
+        fields=[]
+        for field in self._stack:
+            if not fields or fields[-1] is not field:
+                fields.append(field)
+        field_path='.'.join(field.field_name for field in fields)
+        source='.'.join(attr for field in fields for attr in field.source_attrs)
+        relation=self.get_relation(source) if fields[-1].source!='*' else None
+        # a method or a property accessed a relation of the object
+        if relation is None:
+            source, relation=self.attribute(source, sql)
+        lazy_load=LazyLoad(type(self.serializer), field_path, source if relation else None, relation, sql)
+        self.lazy_loads.append(lazy_load)
+
+        if self.mode=='raise':
+            raise NPlusOneError(lazy_load)
+        if self.mode=='learn' and relation is not None:
+            if self.store.add(type(self.serializer), source):
+                plan_cache.invalidate(type(self.serializer))
+                logger.info('Learned source {} for {}'.format(source, type(self.serializer).__name__))
+            return
+        logger.warning(str(lazy_load))
+
+
+    def get_relation(self, source):
+        """returns the last relation visited by source as 'Model.accessor' or None if source does not visit any"""
+        if not source:
+            return None
+        trail=Tracer(self.serializer).trace_source(source)
+        for field in reversed(trail):
+            if field.is_relation:
+                return '{}.{}'.format(field.model.__name__, registry.edge_of(field).accessor)
+        return None
+
+
+    def attribute(self, source, sql, max_depth=3):
+        """
+        returns (source, relation) of the relation that a query of a method or a property loads or (None, None) if the
+        query cannot be attributed. source leads to the object that the field reads.
+        """
+        match=FROM_TABLE.search(sql)
+        target=table_models().get(match.group(1)) if match else None
+        if target is None:
+            return None, None
+
+        model=self.serializer.Meta.model
+        prefix=[]
+        for edge in (Tracer(self.serializer).trace_edges(source) if source else []):
+            if not edge.is_relation or edge.generic:
+                break
+            prefix.append(edge.accessor)
+            model=edge.related_model
+
+        # relations are searched breadth first, a path is learned only if it is the only shortest one
+        level=[(model, [])]
+        visited={model}
+        for _ in range(max_depth):
+            found=[]
+            next_level=[]
+            for current, path in level:
+                for edge in registry.edges(current).values():
+                    if not edge.is_relation or edge.generic:
+                        continue
+                    if edge.related_model is target or through_model(edge) is target:
+                        found.append(path+[edge])
+                    elif edge.related_model not in visited:
+                        visited.add(edge.related_model)
+                        next_level.append((edge.related_model, path+[edge]))
+            if found:
+                if len(found)>1:
+                    return None, None
+                path=found[0]
+                return '.'.join(prefix+[edge.accessor for edge in path]), '{}.{}'.format(path[-1].model.__name__, path[-1].accessor)
+            level=next_level
+        return None, None
+
+
+    def __enter__(self):
+        self._stack_context=ExitStack()
+        aliases=[self.using] if self.using is not None else list(connections)
+        for alias in aliases:
+            self._stack_context.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._stack_context.close()
+        return False
+
+
+def table_models():
+    """returns {db_table: model} of the installed models including the through models of many to many fields"""
+    return {model._meta.db_table: model for model in apps.get_models(include_auto_created=True)}
+
+
+def through_model(edge):
+    """returns through model of a many to many relation, a count() of the relation selects from it"""
+    if not edge.field.many_to_many:
+        return None
+    return (edge.field if edge.reverse else edge.field.remote_field).through
+
+
+class NPlusOneDetectionMixin:
+    """
+    View mixin which runs list() in an NPlusOneDetector with n_plus_one_mode. Serializers with data are instrumented
+    when they are created by get_serializer.
+    """
+    n_plus_one_mode='warn'
+
+    def get_serializer(self, *args, **kwargs):
+        serializer=super().get_serializer(*args, **kwargs)
+        detector=getattr(self, 'n_plus_one_detector', None)
+        if detector is not None and (args or 'instance' in kwargs):
+            detector.instrument(serializer)
+        return serializer
+
+
+    def list(self, request, *args, **kwargs):
+        with NPlusOneDetector(mode=self.n_plus_one_mode) as detector:
+            self.n_plus_one_detector=detector
+            try:
+                return super().list(request, *args, **kwargs)
+            finally:
+                self.n_plus_one_detector=None
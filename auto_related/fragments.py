@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+
+
+class RepresentationCache:
+    """
+    Bounded cache of serialized representations that is shared by requests. Least recently used representations are
+    dropped when there are more than maxsize of them. Representations are copied when they are stored and returned so
+    that a request changing its response cannot change the responses of the others.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize=maxsize
+        self._items=OrderedDict()
+        self._lock=Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            value=self._items.get(key)
+            if value is None:
+                return None
+            self._items.move_to_end(key)
+        return deepcopy(value)
+
+
+    def set(self, key, value):
+        value=deepcopy(value)
+        with self._lock:
+            self._items[key]=value
+            self._items.move_to_end(key)
+            while len(self._items)>self.maxsize:
+                self._items.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+class CachedRepresentationMixin:
+    """
+    Serializer mixin which serializes an instance once and reuses its representation when the same instance is
+    serialized again, like a teacher that is nested under every course it teaches. Representations are keyed on
+    (serializer class, fields, pk, version) where version is the value of version_field such as 'updated_at'.
+
+    Representations are reused in a request by default. If version_field and representation_cache are set they are
+    reused across requests too, an instance gets a new key when its version changes. Tracer adds version_field to the
+    sources of the serializer, so it is not deferred by only().
+
+        class TeacherSerializer(CachedRepresentationMixin, ModelSerializer):
+            version_field='updated_at'
+            representation_cache=RepresentationCache(maxsize=10000)
+
+    Representations should not depend on anything but the instance, for example hyperlinks depend on the request.
+    Cached representations are copied, so changing a returned representation does not change the cached one.
+    """
+    version_field=None
+    representation_cache=None
+
+    def to_representation(self, instance):
+        key=self.get_representation_key(instance)
+        if key is None:
+            return super().to_representation(instance)
+
+        local=self.context.setdefault('_auto_related_representations', {})
+        data=local.get(key)
+        # each position in the response gets its own copy
+        if data is not None:
+            return deepcopy(data)
+        shared=self.representation_cache if self.version_field is not None else None
+        if shared is not None:
+            data=shared.get(key)
+        if data is None:
+            data=super().to_representation(instance)
+            if shared is not None:
+                shared.set(key, data)
+        local[key]=deepcopy(data)
+        return data
+
+
+    def get_representation_key(self, instance):
+        """returns the cache key of instance or None if it should not be cached"""
+        pk=getattr(instance, 'pk', None)
+        if pk is None:
+            return None
+        version=getattr(instance, self.version_field) if self.version_field is not None else None
+        return (type(self), tuple(self.fields), pk, version)
+
+
+def representation_sources(serializer):
+    """returns sources that a serializer reads to build its representation cache keys"""
+    version_field=getattr(serializer, 'version_field', None)
+    if isinstance(serializer, type):
+        cached=issubclass(serializer, CachedRepresentationMixin)
+    else:
+        cached=isinstance(serializer, CachedRepresentationMixin)
+    return [version_field] if cached and version_field is not None else []
@@ -0,0 +1,44 @@
+from inspect import isclass
+
+from rest_framework.fields import Field
+
+
+class GenericRelatedField(Field):
+    """
+    Read only field for a GenericForeignKey which serializes the related object with the serializer of its model.
+    Tracer prefetches the relation with one query per content type and the queryset of each model is planned for
+    its serializer, hence relations of the related objects are not loaded one by one either;
+
+        class CommentSerializer(ModelSerializer):
+            target=GenericRelatedField({Article: ArticleSerializer, Photo: PhotoSerializer()})
+    """
+    def __init__(self, serializers, **kwargs):
+        kwargs['read_only']=True
+        super().__init__(**kwargs)
+        # {model: serializer class or instance}
+        self.serializers=serializers
+
+
+    def bind(self, field_name, parent):
+        super().bind(field_name, parent)
+        self.bound={}
+        for model, serializer in self.serializers.items():
+            serializer=serializer() if isclass(serializer) else serializer
+            # nested serializers reach the context of the root through this field
+            serializer.bind('', self)
+            self.bound[model]=serializer
+
+
+    def get_serializer(self, model):
+        """returns the bound serializer of model"""
+        bound=getattr(self, 'bound', None)
+        if bound is None:
+            return None
+        return bound.get(model) or bound.get(model._meta.concrete_model)
+
+
+    def to_representation(self, value):
+        serializer=self.get_serializer(type(value))
+        if serializer is None:
+            raise TypeError('{} has no serializer for {}'.format(type(self).__name__, type(value).__name__))
+        return serializer.to_representation(value)
@@ -0,0 +1,170 @@
+from collections import Counter
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+import logging
+logger = logging.getLogger("django-auto-related")
+
+
+class QueryStats:
+    """
+    Queries recorded by a QueryRecorder. Sql of a query is used as its signature since parameters are passed
+    separately, hence same signature executed more than once is very likely an n+1 problem.
+    """
+    def __init__(self, tags=None):
+        self.tags=dict(tags or {})
+        self.count=0
+        self.duration=0.0
+        self.signatures=Counter()
+
+
+    def add(self, sql, duration):
+        self.count+=1
+        self.duration+=duration
+        self.signatures[sql]+=1
+
+
+    @property
+    def duplicates(self):
+        """returns {sql: count} of the signatures executed more than once"""
+        return {sql: count for sql, count in self.signatures.items() if count>1}
+
+
+    def as_dict(self):
+        return {
+            'tags': self.tags,
+            'count': self.count,
+            'duration': self.duration,
+            'duplicates': self.duplicates,
+        }
+
+
+    def __repr__(self):
+        return 'QueryStats(count={}, duration={:.6f}, duplicates={}, tags={})'.format(
+            self.count, self.duration, sum(self.duplicates.values()), self.tags)
+
+
+def log_stats(stats):
+    """default callback, logs stats so that they could be shipped to statsd, prometheus etc. by a logging handler"""
+    logger.info('{} queries in {:.6f}s'.format(stats.count, stats.duration), extra={'auto_related_stats': stats.as_dict()})
+
+
+class QueryRecorder:
+    """
+    Context manager that records count, total duration and signatures of the queries executed in it using
+    connection.execute_wrapper. It is safe to use in production since nothing is patched globally.
+
+        with QueryRecorder(view='parent-list') as recorder:
+            data=ParentSerializer(queryset, many=True).data
+        recorder.stats.count
+
+    callback is called with QueryStats on exit. If it is not given stats are logged.
+    """
+    def __init__(self, callback=None, using=None, **tags):
+        self.callback=callback if callback is not None else log_stats
+        self.using=using
+        self.stats=QueryStats(tags)
+        self._stack=None
+
+
+    def __call__(self, execute, sql, params, many, context):
+        start=perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.stats.add(sql, perf_counter()-start)
+
+
+    def __enter__(self):
+        self._stack=ExitStack()
+        aliases=[self.using] if self.using is not None else list(connections)
+        for alias in aliases:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self.callback(self.stats)
+        return False
+
+
+def get_callback():
+    """returns the callable set with AUTO_RELATED_QUERY_CALLBACK setting which could be a dotted path"""
+    callback=getattr(settings, 'AUTO_RELATED_QUERY_CALLBACK', None)
+    if isinstance(callback, str):
+        callback=import_string(callback)
+    return callback
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Records queries of each request with a QueryRecorder. Stats are tagged with the view name and the serializer
+    class of the view if it has one, and passed to AUTO_RELATED_QUERY_CALLBACK or logged.
+    """
+    def __init__(self, get_response):
+        self.get_response=get_response
+        self.callback=get_callback()
+
+
+    def __call__(self, request):
+        recorder=QueryRecorder(self.callback, path=request.path)
+        recorder.__enter__()
+        try:
+            response=self.get_response(request)
+            recorder.stats.tags.update(self.get_tags(request))
+        except BaseException:
+            recorder.__exit__(None, None, None)
+            raise
+        # queries of a streaming response run while the server consumes its content after the view returns.
+        # Content of an async streaming response is consumed in other threads, hence it is not recorded.
+        if response.streaming and not getattr(response, 'is_async', False):
+            response.streaming_content=RecordedContent(response.streaming_content, recorder)
+        else:
+            recorder.__exit__(None, None, None)
+        return response
+
+
+    def get_tags(self, request):
+        match=getattr(request, 'resolver_match', None)
+        if match is None:
+            return {}
+        tags={'view': match.view_name}
+        view_class=getattr(match.func, 'cls', None) or getattr(match.func, 'view_class', None)
+        serializer_class=getattr(view_class, 'serializer_class', None)
+        if serializer_class is not None:
+            tags['serializer']='{}.{}'.format(serializer_class.__module__, serializer_class.__name__)
+        return tags
+
+
+class RecordedContent:
+    """
+    Streaming content of a response whose queries are recorded by recorder. Recorder exits when the content is
+    exhausted or the response is closed.
+    """
+    def __init__(self, content, recorder):
+        self.content=iter(content)
+        self.recorder=recorder
+        self.closed=False
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        try:
+            return next(self.content)
+        except BaseException:
+            self.close()
+            raise
+
+
+    def close(self):
+        if not self.closed:
+            self.closed=True
+            self.recorder.__exit__(None, None, None)
@@ -1,8 +1,39 @@
+from django.db.models import OuterRef, Subquery
 from rest_framework.fields import SerializerMethodField
 
+
+def annotation_name(field_name):
+    """name of the annotation which holds the aggregate of a MethodField"""
+    return '_auto_related_{}'.format(field_name)
+
+
+def pushed_down(model, expression):
+    """
+    returns an expression that could be annotated on any queryset of model. Aggregates are computed in a correlated
+    subquery. Otherwise joins of an aggregate would be mixed with the joins of a prefetch query and rows would be
+    counted more than once.
+    """
+    if not getattr(expression, 'contains_aggregate', False):
+        return expression
+    inner=model._base_manager.filter(pk=OuterRef('pk')).values('pk').annotate(_value=expression).values('_value')
+    return Subquery(inner)
+
+
 class MethodField(SerializerMethodField):
-    def __init__(self, *args, sources=None ,**kwargs):
+    def __init__(self, *args, sources=None, aggregate=None, **kwargs):
         # if double underscore syntax is used change it to dots.
         if sources is not None:
             self._auto_related_sources=[source.replace('__', '.') for source in sources]
+        # an expression like Count('relation') or Exists(...) which mixins annotate on the queryset.
+        # Its value is returned instead of calling the method when it is annotated.
+        self.aggregate=aggregate
         return super().__init__(*args, **kwargs)
+
+
+    def to_representation(self, value):
+        if self.aggregate is not None:
+            try:
+                return getattr(value, annotation_name(self.field_name))
+            except AttributeError:
+                pass
+        return super().to_representation(value)
@@ -9,24 +9,162 @@ from inspect import isclass
 from django.db import models
 from django.db.models.query import QuerySet
 from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from rest_framework.settings import api_settings
+from rest_framework.response import Response
+from rest_framework.utils import encoders
+import json
 from .utils import *
 from .tracer import Tracer, optimized_queryset_given_trails
+from .plan import Plan, plan_cache
+from .sparse import normalize_fields, honors_fields_mask
 
 
 class ViewMixin:
-    def get_queryset(self):
-        t=Tracer(self.get_serializer())
-        traces=t.trace()
-        s,p=optimized_queryset_given_trails(traces)
-        queryset=super().get_queryset()
-        return queryset.select_related(*s).prefetch_related(*p)
+    # set it to False to trace the serializer on every request instead of using cached plans
+    use_plan_cache=True
+    use_only=False
+    # maximum number of instances prefetched in one query. None means all instances are prefetched at once
+    prefetch_batch_size=None
+    # if True instances of the same row are shared in the fetched object graph instead of being created per occurrence
+    use_identity_map=False
+    # if True serializers are traced from their class definitions without being instantiated
+    trace_from_class=False
+    # JoinStrategy deciding whether to-one relations are joined or prefetched. None joins all of them.
+    plan_strategy=None
+    # name of the query parameter that clients pick fields with like ?fields=a,b.c. Plans are built for the requested fields only.
+    fields_param=None
+
+    def get_plan_key(self):
+        """
+        Extra key for plan cache. Override it if fields of the serializer depend on its context
+        (like dynamic fields) and return something hashable identifying the chosen fields.
+        """
+        return None
+
+
+    def get_requested_fields(self):
+        """returns normalized fields requested with fields_param or None if all fields are requested"""
+        if self.fields_param is None:
+            return None
+        value=getattr(self.request, 'query_params', self.request.GET).get(self.fields_param)
+        return (normalize_fields(value) or None) if value else None
+
+
+    def get_serializer_context(self):
+        context=super().get_serializer_context()
+        # SparseFieldsSerializerMixin drops the fields that are not requested. Context is left as it is if fields are not picked by clients.
+        if self.fields_param is not None:
+            context['fields']=self.get_requested_fields()
+        return context
+
+
+    def get_plan(self):
+        strategy=self.plan_strategy
+        serializer_class=self.get_serializer_class()
+        # a serializer that renders all of its fields has one plan whatever is requested
+        fields=self.get_requested_fields() if honors_fields_mask(serializer_class) else None
+        if not self.use_plan_cache:
+            if self.trace_from_class:
+                return Plan.from_serializer(serializer_class, from_class=True, strategy=strategy, fields=fields)
+            return Plan.from_serializer(self.get_serializer(), strategy=strategy, fields=fields)
+        # serializer is instantiated only if the plan is not cached
+        return plan_cache.get(serializer_class, self.get_plan_key(), self.get_serializer, strategy=strategy,
+                              fields=fields, from_class=self.trace_from_class)
 
 
-class ViewMixinWithOnlyOptim:
     def get_queryset(self):
-        t=Tracer(self.get_serializer())
-        traces=t.trace()
-        s,p=optimized_queryset_given_trails(traces)
-        queryset=super().get_queryset()
-        return queryset.select_related(*s).prefetch_related(*p).only(*t.build_only())
+        return self.apply_plan(super().get_queryset())
+
+
+    def apply_plan(self, queryset):
+        return self.get_plan().apply(queryset, use_only=self.use_only, prefetch_batch_size=self.prefetch_batch_size, identity_map=self.use_identity_map)
+
+
+class ViewMixinWithOnlyOptim(ViewMixin):
+    use_only=True
+
+
+class PlanAwarePaginationMixin(ViewMixin):
+    """
+    ViewMixin for paginated list views. Count query and the page query of the paginator run on a slim queryset without
+    the joins, prefetches and annotations of the plan, selecting only primary keys and ordering columns. Then the plan
+    is applied to a queryset of the primary keys of the page only and instances are put back in the order of the page.
+    Filters of the view apply to both of them.
+    """
+    # True while the queryset is built for the paginator
+    plan_deferred=False
+
+    def apply_plan(self, queryset):
+        if self.plan_deferred:
+            return queryset
+        return super().apply_plan(queryset)
+
+
+    def list(self, request, *args, **kwargs):
+        if self.paginator is None:
+            return super().list(request, *args, **kwargs)
+
+        self.plan_deferred=True
+        try:
+            queryset=self.filter_queryset(self.get_queryset())
+        finally:
+            self.plan_deferred=False
+        page=self.paginate_queryset(self.get_slim_queryset(queryset))
+        if page is None:
+            return Response(self.get_serializer(self.apply_plan(queryset), many=True).data)
+        return self.get_paginated_response(self.get_serializer(self.hydrate(queryset, page), many=True).data)
+
+
+    def get_slim_queryset(self, queryset):
+        """returns queryset which selects only primary keys and the columns that the page is ordered by"""
+        ordering=list(queryset.query.order_by)
+        # cursor pagination reads its position from the ordering field of the instances
+        paginator_ordering=getattr(self.paginator, 'ordering', None)
+        ordering+=[paginator_ordering] if isinstance(paginator_ordering, str) else list(paginator_ordering or ())
+        columns=[queryset.model._meta.pk.name]
+        # columns of relations cannot be passed to only() without joining them, KeysetPagination annotates its keys of relations
+        for field in ordering:
+            name=field.lstrip('-') if isinstance(field, str) else None
+            if name and '__' not in name and name!='?' and name!='pk' and name not in columns:
+                columns.append(name)
+        return queryset.select_related(None).prefetch_related(None).only(*columns)
+
+
+    def hydrate(self, queryset, page):
+        """returns instances of the page built with the plan in the order of the page"""
+        pks=[obj.pk for obj in page]
+        objects={obj.pk: obj for obj in self.apply_plan(queryset.order_by()).filter(pk__in=pks)}
+        return [objects[pk] for pk in pks if pk in objects]
+
+
+class StreamingViewMixin:
+    """
+    List view mixin which streams a json array instead of building the whole list in memory. Queryset is iterated
+    in chunks of stream_chunk_size and prefetches of the queryset are done per chunk. Pagination and renderers
+    are not used, output is always json. It is meant to be used together with ViewMixin or ViewMixinWithOnlyOptim.
+    """
+    stream_chunk_size=1000
+
+    def list(self, request, *args, **kwargs):
+        queryset=self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(self.stream(queryset), content_type='application/json')
+
+
+    def encode(self, data):
+        return json.dumps(
+            data,
+            cls=encoders.JSONEncoder,
+            ensure_ascii=not api_settings.UNICODE_JSON,
+            separators=(',', ':') if api_settings.COMPACT_JSON else (', ', ': '),
+        )
+
 
+    def stream(self, queryset):
+        yield '['
+        separator=''
+        for chunk in iterate_in_chunks(queryset, self.stream_chunk_size):
+            for item in self.get_serializer(chunk, many=True).data:
+                yield separator+self.encode(item)
+                separator=','
+        yield ']'
@@ -0,0 +1,153 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset(seek) pagination. A page starts after the keys of the last row of the previous page with a predicate like
+    (a, b) > (x, y) instead of an offset, hence deep pages cost as much as the first one as long as the ordering keys
+    are indexed. Keys should be non null model fields of the queryset or of its to-one relations like 'author__name',
+    and the last one should be unique.
+
+    It is meant to be used with PlanAwarePaginationMixin so that the seek query selects only primary keys and the keys,
+    then the page is built with the traced plan;
+
+        class ParentList(PlanAwarePaginationMixin, generics.ListAPIView):
+            serializer_class = SomeSerializer
+            queryset=Parent.objects.all()
+            pagination_class=KeysetPagination
+
+    Only next pages are linked.
+    """
+    ordering='-pk'
+    page_size=api_settings.PAGE_SIZE
+    page_size_query_param=None
+    max_page_size=None
+    cursor_query_param='after'
+    invalid_cursor_message='Invalid cursor'
+
+    def __init__(self):
+        self.next_keys=None
+        self.request=None
+
+
+    def get_keys(self):
+        return (self.ordering,) if isinstance(self.ordering, str) else tuple(self.ordering)
+
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(request.query_params[self.page_size_query_param], strict=True, cutoff=self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size=self.get_page_size(request)
+        if not page_size:
+            return None
+        self.request=request
+        keys=self.get_keys()
+        attributes=self.key_attributes(keys)
+        # keys of relations are annotated since related instances are not loaded by a slim queryset
+        annotations={attribute: F(key.lstrip('-')) for key, attribute in zip(keys, attributes) if attribute!=key.lstrip('-')}
+        if annotations:
+            queryset=queryset.annotate(**annotations)
+        queryset=queryset.order_by(*keys)
+        cursor=request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset=queryset.filter(self.seek(keys, self.decode_cursor(cursor, keys, queryset.model)))
+
+        page=list(queryset[:page_size+1])
+        self.next_keys=None
+        if len(page)>page_size:
+            page=page[:page_size]
+            self.next_keys=[getattr(page[-1], attribute) for attribute in attributes]
+        return page
+
+
+    @staticmethod
+    def key_attributes(keys):
+        """returns attributes of the instances that values of the keys are read from"""
+        names=[key.lstrip('-') for key in keys]
+        return [name if LOOKUP_SEP not in name else '_auto_related_key_{}'.format(i) for i, name in enumerate(names)]
+
+
+    @staticmethod
+    def seek(keys, values):
+        """returns the predicate of the rows after values. (a, b) > (x, y) is a > x or (a = x and b > y)"""
+        predicate=Q()
+        for i, key in enumerate(keys):
+            name=key.lstrip('-')
+            condition=Q(**{'{}__{}'.format(name, 'lt' if key.startswith('-') else 'gt'): values[i]})
+            for previous, value in zip(keys[:i], values[:i]):
+                condition&=Q(**{previous.lstrip('-'): value})
+            predicate|=condition
+        return predicate
+
+
+    def encode_cursor(self, values):
+        return urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+
+    def decode_cursor(self, cursor, keys, model):
+        """returns values of the keys in cursor converted by their model fields. Cursors come from clients, NotFound is raised if it is invalid"""
+        try:
+            values=json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values)!=len(keys):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            values=[self.key_field(model, key).to_python(value) for key, value in zip(keys, values)]
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        # keys are non null
+        if any(value is None for value in values):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+
+    @staticmethod
+    def key_field(model, key):
+        """returns the model field of an ordering key like '-created' or 'author__name'"""
+        *relations, name=key.lstrip('-').split(LOOKUP_SEP)
+        for relation in relations:
+            model=model._meta.get_field(relation).related_model
+        return model._meta.pk if name=='pk' else model._meta.get_field(name)
+
+
+    def get_next_link(self):
+        if self.next_keys is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.next_keys))
+
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from inspect import isclass
+from threading import Lock
+
+from django.db.models import Prefetch
+
+from .method_field import pushed_down
+from .sparse import normalize_fields
+from .cache import relation_caches
+from .tracer import Tracer, optimized_queryset_given_trails, fill_paths_given_trails
+from .queryset import planned_queryset
+
+
+class Plan:
+    """
+    Precomputed arguments of select_related(), prefetch_related() and only() for a serializer.
+    Tracing a serializer always gives the same result for the same serializer class, so a plan
+    is built once and applied to every queryset afterwards.
+    """
+    def __init__(self, select, prefetch, only, prefetch_paths=(), prefetch_only=None, annotations=None, fill_paths=()):
+        self.select=tuple(select)
+        self.prefetch=tuple(prefetch)
+        self.only=tuple(only)
+        # aggregates of MethodFields annotated on the queryset itself
+        self.annotations=dict(annotations or {})
+        # foreign keys filled from relation caches after the queryset is fetched
+        self.fill_paths=tuple(fill_paths)
+        # Prefetch objects whose querysets are pruned with only() as well
+        self.prefetch_only=tuple(prefetch_only) if prefetch_only is not None else self.prefetch
+        # string form of the prefetch lookups. They are used when a Prefetch object of the plan is overridden.
+        self.prefetch_paths=tuple(prefetch_paths)
+
+
+    @classmethod
+    def from_serializer(cls, serializer, from_class=False, strategy=None, fields=None):
+        t=Tracer(serializer, from_class, fields)
+        trails=t.trace()
+        aggregates=t.aggregates()
+        generics=t.generic_serializers()
+        model=t.serializer.Meta.model
+        annotations={name: pushed_down(model, expression) for trail, name, expression in aggregates if not len(trail)}
+        caches=relation_caches if relation_caches else None
+        s,p=optimized_queryset_given_trails(trails, prefetch_objects=True, strategy=strategy, aggregates=aggregates, caches=caches, generics=generics)
+        _,p_only=optimized_queryset_given_trails(trails, prefetch_objects=True, column_trails=t.column_trails(), strategy=strategy, aggregates=aggregates, caches=caches, generics=generics)
+        _,paths=optimized_queryset_given_trails(trails, strategy=strategy, caches=caches)
+        fill_paths=fill_paths_given_trails(trails, caches, strategy) if caches else ()
+        by_lookup=lambda prefetch: prefetch.prefetch_to
+        return cls(sorted(s), sorted(p, key=by_lookup), sorted(t.build_only()), sorted(paths), sorted(p_only, key=by_lookup), annotations, sorted(fill_paths))
+
+
+    def apply(self, queryset, use_only=False, prefetch_batch_size=None, identity_map=False):
+        # Lookups of the plan are put before the ones already set on the queryset. Otherwise a string lookup like
+        # 'a__b' would prefetch 'a' first and Prefetch('a', queryset=...) of the plan would be rejected by django.
+        # Prefetch objects set explicitly on the queryset win over the ones in the plan, deeper relations of them
+        # are still prefetched with string lookups.
+        existing=queryset._prefetch_related_lookups
+        explicit={lookup.prefetch_to for lookup in existing if isinstance(lookup, Prefetch) and lookup.queryset is not None}
+        prefetch=[lookup for lookup in (self.prefetch_only if use_only else self.prefetch) if lookup.prefetch_to not in explicit]
+        under_explicit=[path for path in self.prefetch_paths if any(path.startswith(e+'__') for e in explicit)]
+        # select_related() without arguments would join every non null foreign key
+        if self.select:
+            queryset=queryset.select_related(*self.select)
+        queryset=queryset.prefetch_related(None).prefetch_related(*prefetch, *existing, *under_explicit)
+        if self.annotations:
+            queryset=queryset.annotate(**self.annotations)
+        if use_only:
+            queryset=queryset.only(*self.only)
+        # prefetch queries are split so that their IN clauses have at most prefetch_batch_size parameters
+        if prefetch_batch_size is not None or self.fill_paths or identity_map:
+            queryset=planned_queryset(queryset, prefetch_batch_size=prefetch_batch_size, fill_paths=self.fill_paths, identity_map=identity_map)
+        return queryset
+
+
+    def __repr__(self):
+        return 'Plan(select={}, prefetch={}, only={})'.format(self.select, tuple(p.prefetch_to for p in self.prefetch), self.only)
+
+
+class PlanCache:
+    """
+    Process wide cache of plans keyed on serializer class, an optional context key, the join strategy, requested fields and
+    whether the plan is traced from the class definition. Context key is needed only when the fields of a serializer depend
+    on its context in a way that requested fields do not cover. Otherwise it is None.
+
+    If maxsize is given least recently used plans are dropped when there are more plans than maxsize. Requested fields
+    come from clients, hence the module level plan_cache is bounded.
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize=maxsize
+        self._plans=OrderedDict()
+        self._lock=Lock()
+
+
+    def get(self, serializer_class, context_key=None, serializer=None, strategy=None, fields=None, from_class=False):
+        """
+        returns cached plan of the serializer class. On a miss plan is built by tracing the class definition of
+        serializer_class if from_class is True, otherwise by tracing serializer. serializer could be an instance or a
+        callable returning one like get_serializer of a view, which is called only on a miss. If it is not given an
+        instance of serializer_class is created without arguments. fields are the requested fields like 'a,b.c'.
+        """
+        fields=normalize_fields(fields) if fields is not None else None
+        key=(serializer_class, context_key, strategy, fields, from_class)
+        plan=self._plans.get(key)
+        if plan is None:
+            if from_class:
+                plan=Plan.from_serializer(serializer_class, from_class=True, strategy=strategy, fields=fields)
+            else:
+                serializer=serializer if serializer is not None else serializer_class
+                serializer=serializer() if callable(serializer) else serializer
+                plan=Plan.from_serializer(serializer, strategy=strategy, fields=fields)
+            with self._lock:
+                plan=self._plans.setdefault(key, plan)
+                if self.maxsize is not None:
+                    while len(self._plans)>self.maxsize:
+                        self._plans.popitem(last=False)
+        elif self.maxsize is not None:
+            with self._lock:
+                if key in self._plans:
+                    self._plans.move_to_end(key)
+        return plan
+
+
+    def invalidate(self, serializer_class=None):
+        """removes plans of the given serializer class or all plans if it is not given"""
+        with self._lock:
+            if serializer_class is None:
+                self._plans.clear()
+                return
+            for key in [key for key in self._plans if key[0] is serializer_class]:
+                del self._plans[key]
+
+
+    def warm(self, *serializers, from_class=False):
+        """
+        builds plans beforehand so that first requests do not pay for tracing. Could be called in AppConfig.ready().
+        Serializers are expected to be classes, instances or (serializer, context_key, strategy, fields) tuples whose
+        trailing items could be omitted. Plans are traced from instances like the mixins do, a class is instantiated
+        without arguments. Pass an instance if fields of the serializer depend on its context, or from_class=True to
+        warm the plans of views with trace_from_class.
+        """
+        for serializer in serializers:
+            key=tuple(serializer) if isinstance(serializer, tuple) else (serializer,)
+            serializer, context_key, strategy, fields=key+(None,)*(4-len(key))
+            serializer_class=serializer if isclass(serializer) else type(serializer)
+            self.get(serializer_class, context_key, serializer, strategy=strategy, fields=fields, from_class=from_class)
+
+
+    def __contains__(self, key):
+        # trailing items of (serializer_class, context_key, strategy, fields, from_class) could be omitted
+        key=key if isinstance(key, tuple) else (key,)
+        key=key+(None, None, None, False)[len(key)-1:]
+        if key[3] is not None:
+            key=key[:3]+(normalize_fields(key[3]),)+key[4:]
+        return key in self._plans
+
+
+    def __len__(self):
+        return len(self._plans)
+
+
+plan_cache=PlanCache(maxsize=1024)
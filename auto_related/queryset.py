@@ -0,0 +1,183 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Model, Prefetch, prefetch_related_objects
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import ModelIterable, normalize_prefetch_lookups
+
+from .cache import fill_relations
+
+
+def batched_prefetch_related_objects(instances, lookups, batch_size):
+    """
+    same as django's prefetch_related_objects but every prefetch query has at most batch_size instances in its IN
+    clause. Relations are prefetched one level at a time, instances of a level are prefetched in batches of batch_size
+    and the related objects they get are collected to prefetch the next level in batches again. Nested lookups of
+    Prefetch querysets are moved to the next level instead of being prefetched for a whole batch at once.
+    """
+    if not instances or not lookups:
+        return
+    # {lookup of the first level: lookups relative to the objects it prefetches}
+    levels={}
+    firsts={}
+    for lookup in normalize_prefetch_lookups(lookups):
+        first, _, rest=lookup.prefetch_through.partition(LOOKUP_SEP)
+        if not rest:
+            querysets=getattr(lookup, 'querysets', None)
+            if querysets is None and lookup.queryset is not None and lookup.queryset._prefetch_related_lookups:
+                # lookups of the queryset are relative to the objects it fetches
+                levels.setdefault(lookup.prefetch_to, []).extend(normalize_prefetch_lookups(lookup.queryset._prefetch_related_lookups))
+                lookup=Prefetch(lookup.prefetch_through, lookup.queryset.prefetch_related(None), to_attr=lookup.to_attr)
+            # GenericPrefetch querysets are kept as they are, generic foreign keys fetch one object per instance
+            firsts[lookup.prefetch_to]=lookup
+            levels.setdefault(lookup.prefetch_to, [])
+        else:
+            firsts.setdefault(first, Prefetch(first))
+            levels.setdefault(first, []).append(relative_lookup(lookup, rest))
+
+    first_lookups=list(firsts.values())
+    for i in range(0, len(instances), batch_size):
+        prefetch_related_objects(instances[i:i+batch_size], *first_lookups)
+    for attr, rest in levels.items():
+        if rest:
+            batched_prefetch_related_objects(related_objects(instances, attr), rest, batch_size)
+
+
+def relative_lookup(lookup, through):
+    """returns a copy of a Prefetch object whose path is through"""
+    querysets=getattr(lookup, 'querysets', None)
+    if querysets is not None:
+        return type(lookup)(through, querysets, to_attr=lookup.to_attr)
+    return Prefetch(through, queryset=lookup.queryset, to_attr=lookup.to_attr)
+
+
+def related_objects(instances, attr):
+    """returns the objects prefetched or selected at attr of instances, like prefetch_related_objects collects them"""
+    res=[]
+    for obj in instances:
+        prefetched=getattr(obj, '_prefetched_objects_cache', {})
+        if attr in prefetched:
+            res.extend(prefetched[attr])
+            continue
+        try:
+            value=getattr(obj, attr)
+        except ObjectDoesNotExist:
+            continue
+        if isinstance(value, list):
+            res.extend(value)
+        elif isinstance(value, Model):
+            res.append(value)
+        # related manager of a reverse many to many relation caches its objects by the related query name
+        elif getattr(value, 'prefetch_cache_name', None) in prefetched:
+            res.extend(prefetched[value.prefetch_cache_name])
+    return res
+
+
+def share_instances(instances):
+    """
+    Identity map for a fetched object graph. Instances of the same row that are reached through different relations,
+    or through the same to-many relation of different instances, are replaced with one instance in the related object
+    caches of instances and of their related instances. instances should be a list. Columns, annotations and related object caches that only a
+    replaced instance has are moved to the one that is kept, so nothing is fetched again. Returns the instances.
+    """
+    seen={}
+    stack=[]
+
+    def share(obj):
+        if obj is None or obj.pk is None:
+            return obj
+        key=(obj._meta.concrete_model, obj.pk)
+        kept=seen.get(key)
+        if kept is None:
+            seen[key]=obj
+            stack.append(obj)
+            return obj
+        # loaded state of the replaced instance is merged and its related objects are visited through the kept one
+        if kept is not obj and merge_instance(kept, obj):
+            stack.append(kept)
+        return kept
+
+    instances[:]=[share(obj) for obj in instances]
+    while stack:
+        obj=stack.pop()
+        fields_cache=obj._state.fields_cache
+        for name, related in list(fields_cache.items()):
+            fields_cache[name]=share(related)
+        for related_manager in getattr(obj, '_prefetched_objects_cache', {}).values():
+            result=getattr(related_manager, '_result_cache', None)
+            if result:
+                result[:]=[share(each) for each in result]
+    return instances
+
+
+def merge_instance(target, other):
+    """copies loaded columns, annotations and related object caches of other that target does not have. returns True if any"""
+    changed=False
+    for name, value in other.__dict__.items():
+        if name not in target.__dict__:
+            target.__dict__[name]=value
+            changed=True
+    fields_cache=target._state.fields_cache
+    for name, value in other._state.fields_cache.items():
+        if name not in fields_cache:
+            fields_cache[name]=value
+            changed=True
+    prefetched=getattr(target, '_prefetched_objects_cache', None)
+    if prefetched is not None:
+        for name, value in getattr(other, '_prefetched_objects_cache', {}).items():
+            if name not in prefetched:
+                prefetched[name]=value
+                changed=True
+    return changed
+
+
+class PlannedQuerySetMixin:
+    """
+    Mixed into the class of a queryset by planned_queryset() to change how its results are post processed
+    after they are fetched, for example to prefetch them in batches or to fill their cached relations.
+    """
+    prefetch_batch_size=None
+    # paths of foreign keys filled from relation caches, see auto_related.cache
+    fill_paths=()
+    # if True each row is a single instance in the fetched object graph, see share_instances
+    identity_map=False
+
+    def _clone(self):
+        clone=super()._clone()
+        clone.prefetch_batch_size=self.prefetch_batch_size
+        clone.fill_paths=self.fill_paths
+        clone.identity_map=self.identity_map
+        return clone
+
+
+    def _fetch_all(self):
+        fetched=self._result_cache is None
+        super()._fetch_all()
+        if not fetched or self._iterable_class is not ModelIterable:
+            return
+        if self.fill_paths:
+            fill_relations(self._result_cache, self.fill_paths)
+        if self.identity_map:
+            share_instances(self._result_cache)
+
+
+    def _prefetch_related_objects(self):
+        if self.prefetch_batch_size is None:
+            return super()._prefetch_related_objects()
+        batched_prefetch_related_objects(self._result_cache, self._prefetch_related_lookups, self.prefetch_batch_size)
+        self._prefetch_done=True
+
+
+_planned_classes={}
+
+def planned_queryset(queryset, prefetch_batch_size=None, fill_paths=(), identity_map=False):
+    """returns a copy of queryset whose class is extended with PlannedQuerySetMixin"""
+    cls=queryset.__class__
+    if not issubclass(cls, PlannedQuerySetMixin):
+        if cls not in _planned_classes:
+            _planned_classes[cls]=type('Planned'+cls.__name__, (PlannedQuerySetMixin, cls), {})
+        cls=_planned_classes[cls]
+    clone=queryset._chain()
+    clone.__class__=cls
+    clone.prefetch_batch_size=prefetch_batch_size
+    clone.fill_paths=tuple(fill_paths)
+    clone.identity_map=identity_map
+    return clone
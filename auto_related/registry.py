@@ -0,0 +1,148 @@
+from collections import namedtuple
+from threading import Lock
+from types import MappingProxyType
+
+from django.apps import apps
+from django.db.models.fields.reverse_related import ForeignObjectRel, OneToOneRel
+from django.db.models.fields.related import ForeignKey
+
+
+class Edge(namedtuple('Edge', ['model', 'field', 'accessor', 'related_model', 'many', 'reverse', 'select'])):
+    """
+    An accessor of a model in the relation graph. For relations related_model is the model it leads to,
+    many tells its cardinality(to-many or to-one), reverse tells its direction and select tells if it could
+    be passed to select_related(). Non related fields are edges too, their related_model is None.
+    A GenericForeignKey is a relation whose related_model is None since it is known per instance.
+    """
+    __slots__=()
+
+    @classmethod
+    def from_field(cls, model, field, accessor):
+        related_model=field.related_model if field.is_relation else None
+        return cls(
+            model,
+            field,
+            accessor,
+            related_model,
+            related_model is not None and bool(field.many_to_many or field.one_to_many),
+            isinstance(field, ForeignObjectRel),
+            # django docs: You can refer to any ForeignKey or OneToOneField relation in the list of fields passed to select_related().
+            # You can also refer to the reverse direction of a OneToOneField
+            isinstance(field, (ForeignKey, OneToOneRel)),
+        )
+
+
+    @property
+    def is_relation(self):
+        return self.related_model is not None or self.generic
+
+
+    @property
+    def generic(self):
+        """True for a GenericForeignKey"""
+        return self.related_model is None and self.field.is_relation
+
+
+    # an accessor identifies an edge of a model, hashing django fields and their relations is much slower
+    def __hash__(self):
+        return hash((self.model, self.accessor))
+
+
+    def __eq__(self, other):
+        return self is other or isinstance(other, Edge) and self.model is other.model and self.accessor==other.accessor and self.field is other.field
+
+
+    def __ne__(self, other):
+        return not self==other
+
+
+class ModelRegistry:
+    """
+    Relation graph of models. Each model is a node whose edges are its fields keyed on their accessor names so that a
+    source like 'child.child.text' could be resolved with one dict lookup per part instead of scanning all fields of a
+    model. Accessor names, cardinalities and directions of relations are computed once hence _meta is not introspected
+    on the request path. Nodes are read only mappings.
+
+    It is built for all installed models when auto_related app is ready and lazily for models that are not seen
+    before(for example when auto_related is not in INSTALLED_APPS).
+    """
+    def __init__(self):
+        self._nodes={}
+        # edges by their django fields, used to find the accessor of a field
+        self._edges={}
+        self._lock=Lock()
+
+
+    @staticmethod
+    def get_accessor(field):
+        #ForeignObjectRel instances have this attribute. returns default name like 'parent_set' or related_name if it is set
+        if hasattr(field, 'get_accessor_name'):
+            return field.get_accessor_name()
+        else:
+            #NOTE: there is also field.attname. It might be more appropriate
+            return field.name
+
+
+    def build_model(self, model):
+        edges={}
+        for f in model._meta.get_fields():
+            accessor=self.get_accessor(f)
+            # first field wins just like the list scan it replaces
+            if accessor not in edges:
+                edges[accessor]=Edge.from_field(model, f, accessor)
+        with self._lock:
+            node=self._nodes.setdefault(model, MappingProxyType(edges))
+            for edge in node.values():
+                self._edges.setdefault(edge.field, edge)
+            return node
+
+
+    def build(self, models=None):
+        """builds nodes of the given models or all installed models"""
+        for model in (models if models is not None else apps.get_models(include_auto_created=True)):
+            self.build_model(model)
+
+
+    def edges(self, model):
+        """returns read only {accessor: Edge} mapping of the model"""
+        edges=self._nodes.get(model)
+        if edges is None:
+            edges=self.build_model(model)
+        return edges
+
+
+    def edge(self, model, accessor):
+        """returns the edge of the model that is accessed by accessor or None if there is no such field"""
+        return self.edges(model).get(accessor)
+
+
+    def edge_of(self, field):
+        """returns the edge of a django field"""
+        edge=self._edges.get(field)
+        if edge is None:
+            self.build_model(field.model)
+            edge=self._edges.get(field)
+        if edge is None:
+            # a field that is shadowed by another one with the same accessor
+            edge=Edge.from_field(field.model, field, self.get_accessor(field))
+        return edge
+
+
+    def accessors(self, model):
+        """returns {accessor: field} dict of the model"""
+        return {accessor: edge.field for accessor, edge in self.edges(model).items()}
+
+
+    def get_field(self, model, accessor):
+        """returns django field of the model that is accessed by accessor or None if there is no such field"""
+        edge=self.edge(model, accessor)
+        return edge.field if edge is not None else None
+
+
+    def clear(self):
+        with self._lock:
+            self._nodes.clear()
+            self._edges.clear()
+
+
+registry=ModelRegistry()
@@ -0,0 +1,85 @@
+from functools import lru_cache
+from inspect import isclass
+
+from rest_framework.serializers import ListSerializer
+
+
+def normalize_fields(value):
+    """
+    Normalizes requested fields like 'b.c, a' or ['b.c', 'a'] to a sorted tuple like ('a', 'b.c') so that the same
+    request always gives the same plan cache key. Paths under a field that is requested as a whole are dropped.
+    """
+    if isinstance(value, str):
+        value=value.split(',')
+    paths=sorted({path.strip().strip('.') for path in value if path.strip().strip('.')})
+    res=[]
+    for path in paths:
+        if not any(path.startswith(prefix+'.') for prefix in res):
+            res.append(path)
+    return tuple(res)
+
+
+@lru_cache(maxsize=1024)
+def fields_mask(fields):
+    """
+    returns nested dict of normalized fields like {'a': None, 'b': {'c': None}}. None means that all fields of it are
+    requested. Masks are cached hence they should not be modified.
+    """
+    mask={}
+    for path in fields:
+        parts=path.split('.')
+        node=mask
+        for part in parts[:-1]:
+            node=node.setdefault(part, {})
+        node[parts[-1]]=None
+    return mask
+
+
+def honors_fields_mask(serializer):
+    """
+    returns True if a serializer class or instance drops the fields that are not requested. Sources of the other
+    serializers are traced as a whole since they render all of their fields whatever is requested.
+    """
+    if not isclass(serializer):
+        serializer=type(getattr(serializer, 'child', serializer))
+    return issubclass(serializer, SparseFieldsSerializerMixin)
+
+
+class SparseFieldsSerializerMixin:
+    """
+    Serializer mixin which drops the fields that are not requested. Requested fields are read from context['fields']
+    which ViewMixin sets from the query parameter named with its fields_param. Nested serializers get their own part
+    of the request, like 'c' of 'b.c', if they and all serializers above them use this mixin too.
+
+        class ParentSerializer(SparseFieldsSerializerMixin, ModelSerializer):
+            ...
+    """
+    def get_fields(self):
+        fields=super().get_fields()
+        mask=self.get_fields_mask()
+        if mask is None:
+            return fields
+        return {name: field for name, field in fields.items() if name in mask}
+
+
+    def get_fields_mask(self):
+        """returns the mask of this serializer or None if all of its fields are requested"""
+        requested=self.context.get('fields')
+        if not requested:
+            return None
+        path=[]
+        node=self
+        while node.parent is not None:
+            # child of a ListSerializer has no field name, ListSerializer has it
+            if node.field_name:
+                path.append(node.field_name)
+            node=node.parent
+            # a parent without this mixin renders all of its fields, so does this serializer. Tracer assumes the same.
+            if not isinstance(node, ListSerializer) and not honors_fields_mask(node):
+                return None
+        mask=fields_mask(requested)
+        for name in reversed(path):
+            if mask is None or name not in mask:
+                return None
+            mask=mask[name]
+        return mask
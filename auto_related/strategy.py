@@ -0,0 +1,83 @@
+class JoinStrategy:
+    """
+    Decides whether a to-one relation is joined with select_related or fetched with its own query like a to-many
+    relation. Default strategy joins every to-one relation. Subclass it and override join() to tune it per endpoint.
+
+    Strategies are part of plan cache keys, hence they should be created once, for example as class attributes of views.
+    """
+    # estimated size in bytes of a column by django's internal type of its field
+    FIELD_WIDTHS={
+        'AutoField': 4, 'SmallAutoField': 2, 'BigAutoField': 8,
+        'IntegerField': 4, 'SmallIntegerField': 2, 'BigIntegerField': 8,
+        'PositiveIntegerField': 4, 'PositiveSmallIntegerField': 2, 'PositiveBigIntegerField': 8,
+        'BooleanField': 1, 'FloatField': 8, 'DecimalField': 16,
+        'DateField': 4, 'DateTimeField': 8, 'TimeField': 8, 'DurationField': 8,
+        'UUIDField': 16, 'ForeignKey': 8, 'OneToOneField': 8,
+    }
+    # used for text, json, binary and unknown fields
+    default_width=256
+
+    def join(self, field, depth, width):
+        """
+        returns True if field should be joined to its parent. depth is the number of joins from the model of the queryset
+        including this one and width is the estimated width of a row of the query if it is joined.
+        """
+        return True
+
+
+    def row_width(self, model):
+        """estimated width in bytes of a row of the model"""
+        return sum(self.field_width(field) for field in model._meta.concrete_fields)
+
+
+    def field_width(self, field):
+        internal_type=field.get_internal_type()
+        if internal_type in self.FIELD_WIDTHS:
+            return self.FIELD_WIDTHS[internal_type]
+        max_length=getattr(field, 'max_length', None)
+        return max_length if max_length else self.default_width
+
+
+class CostBasedJoinStrategy(JoinStrategy):
+    """
+    Joins a to-one relation unless;
+        it is deeper than max_join_depth in a select_related chain
+        the joined row would be wider than max_row_width bytes
+        table_stats tells that the related table is small enough that reading each of its rows once in a separate query
+        is cheaper than repeating them in every row of the parent. An extra query costs as much as query_cost bytes.
+
+    table_stats maps models or their labels like 'app.Model' to estimated row counts. It could also be a callable
+    which takes a model and returns its row count or None.
+
+        class ParentList(ViewMixin, ListAPIView):
+            plan_strategy=CostBasedJoinStrategy(max_join_depth=2, table_stats={'testerapp.Child': 50})
+    """
+    def __init__(self, max_join_depth=None, max_row_width=None, table_stats=None, query_cost=65536):
+        self.max_join_depth=max_join_depth
+        self.max_row_width=max_row_width
+        self.table_stats=table_stats
+        self.query_cost=query_cost
+
+
+    def join(self, field, depth, width):
+        if self.max_join_depth is not None and depth>self.max_join_depth:
+            return False
+        if self.max_row_width is not None and width>self.max_row_width:
+            return False
+        rows, related_rows=self.get_rows(field.model), self.get_rows(field.related_model)
+        if rows is None or related_rows is None:
+            return True
+        related_width=self.row_width(field.related_model)
+        # joined columns are repeated for each row of the parent while a prefetch reads each related row at most once
+        return rows*related_width<=min(rows, related_rows)*related_width+self.query_cost
+
+
+    def get_rows(self, model):
+        """estimated row count of the model's table or None if it is not known"""
+        if self.table_stats is None:
+            return None
+        if callable(self.table_stats):
+            return self.table_stats(model)
+        if model in self.table_stats:
+            return self.table_stats[model]
+        return self.table_stats.get(model._meta.label)
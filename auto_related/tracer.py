@@ -1,14 +1,19 @@
-from .utils import get_all_sources
+from .utils import get_all_sources, get_class_sources, get_aggregates, get_generic_serializers, learned_sources
+from .method_field import pushed_down
+from .sparse import normalize_fields, fields_mask
+from .queryset import planned_queryset
+from .registry import Edge, registry
 from django.db.models.fields.reverse_related import (
     ForeignObjectRel, ManyToManyRel, ManyToOneRel, OneToOneRel,
 )
 from django.db.models.fields.related import (
-    RelatedField as DjangoRelatedField, ForeignKey, OneToOneField
+    RelatedField as DjangoRelatedField, ForeignKey, OneToOneField, ManyToManyField
 )
+from django.db.models import Prefetch
 from django.utils.translation import gettext_lazy as _
 from rest_framework.fields import SerializerMethodField
-
-from functools import lru_cache
+from threading import Lock
+from weakref import WeakValueDictionary
 
 import logging
 
@@ -24,10 +29,14 @@ def select_and_prefetch(trace):
     prefetch_related for that trail. It works for only one trail so It should be applied to all 
     sources of a serializer and resulting sets should be combined. 
     """
+    # a Trail computes them once when it is created
+    if isinstance(trace, Trail):
+        return trace.select, trace.prefetch
+
     select=[]
     prefetch=[]
     for field in trace:
-        if isinstance(field['field'], (OneToOneRel, ForeignKey, OneToOneField)):
+        if field['edge'].select:
             select.append(field['accessor'])
             continue
         elif field['field'].related_model is None:
@@ -40,23 +49,313 @@ def select_and_prefetch(trace):
     return "__".join(select), "__".join(prefetch)
 
 
+# relations which are joined to their parents by a foreign key or a through table hence their querysets could be pruned with only().
+# Foreign keys are here for the ones that a JoinStrategy decides to prefetch.
+PRUNABLE_RELATIONS=(ManyToOneRel, ManyToManyRel, ManyToManyField, ForeignKey)
+
+
+def is_prunable(field):
+    # a GenericRelation is joined to its parents by its object id column like a reverse foreign key
+    return isinstance(field, PRUNABLE_RELATIONS) or hasattr(field, 'object_id_field_name')
+
+
+class RelationNode:
+    """
+    A node of the relation trie built from trails. Each node is a related field visited by at least one trail
+    and its children are the related fields visited after it. Trails sharing a prefix share the same nodes
+    hence each relation appears once no matter how many sources go through it.
+    """
+    def __init__(self, edge=None):
+        self.edge=edge
+        self.field=edge.field if edge is not None else None
+        self.accessor=edge.accessor if edge is not None else None
+        self.children={}
+        # what to pass to only() when this node is prefetched with its own queryset. Paths are relative to this node.
+        self.columns=set()
+        # True if whole object is needed(for example a StringRelatedField) hence only() should not be used
+        self.whole=False
+        # False if this to-one relation is prefetched with its own queryset instead of being joined, see decide()
+        self.joined=edge is not None and edge.select
+        # {annotation_name: expression} of MethodField aggregates annotated on the queryset of this node
+        self.annotations={}
+        # True if this foreign key is filled from a relation cache instead of being joined or prefetched, see cache()
+        self.cached=False
+        # {model: serializer} of a GenericForeignKey whose related objects are prefetched with querysets planned for them
+        self.targets={}
+
+
+    def add(self, trail):
+        node=self
+        for edge in trail.edges:
+            # non related fields are columns, they do not affect select_related and prefetch_related
+            if not edge.is_relation:
+                break
+            child=node.children.get(edge.accessor)
+            if child is None:
+                child=node.children[edge.accessor]=RelationNode(edge)
+            node=child
+        return node
+
+
+    def find(self, trail):
+        """returns the node trail ends at or None if it is not in the trie"""
+        node=self
+        for edge in trail.edges:
+            node=node.children.get(edge.accessor)
+            if node is None:
+                return None
+        return node
+
+
+    def select_and_prefetch(self, prefix=()):
+        """
+        returns minimal select_related and prefetch_related arguments for the subtree of this node. Only the deepest
+        path of a select_related chain is emitted since select_related('a__b') also selects 'a'. Same is true for prefetch
+        paths. A to-many relation under a select_related chain is prefetched through that chain like 'fk__m2m'.
+        """
+        select=[]
+        prefetch=[]
+        for child in self.children.values():
+            path=prefix+(child.accessor,)
+            if child.cached:
+                continue
+            if child.joined:
+                s,p=child.select_and_prefetch(path)
+                # if nothing is selected below this node it is the end of a select chain
+                select+=s if s else ['__'.join(path)]
+                prefetch+=p
+            else:
+                prefetch+=child.prefetch_leaves(path)
+        return select, prefetch
+
+
+    def add_columns(self, trail, whole=False):
+        """
+        Records columns that trail accesses on the queryset it belongs to. Columns of a to-many relation are recorded
+        on its node since it is prefetched with its own queryset. It should be called after all trails are added.
+        """
+        root=self
+        node=self
+        path=[]
+        for i, edge in enumerate(trail.edges):
+            field=edge.field
+            child=node.children.get(edge.accessor) if node is not None and edge.is_relation else None
+            if edge.is_relation and not (child.joined if child is not None else edge.select):
+                # this relation is not prefetched, only its pk is used like a PrimaryKeyRelatedField
+                if child is None:
+                    break
+                # parent needs the foreign key column of a prefetched to-one relation to match them
+                if edge.select and not edge.reverse:
+                    root.columns.add('__'.join(path+[edge.accessor]))
+                # a generic foreign key is matched by its content type and object id columns
+                elif edge.generic:
+                    root.columns.update('__'.join(path+[column]) for column in (field.ct_field, field.fk_field))
+                node=child
+                root=node
+                path=[]
+                # only() is not used for to-many relations that are not joined by their pk or a foreign key
+                if not is_prunable(field) or i==len(trail)-1 and whole:
+                    root.whole=True
+                continue
+            # only() does not support reverse relations other than joined one to one relations
+            if edge.reverse and not edge.select:
+                break
+            path.append(edge.accessor)
+            if edge.is_relation and node is not None:
+                node=node.children.get(edge.accessor)
+        if path:
+            root.columns.add('__'.join(path))
+
+
+    def plan(self, prefix=(), use_only=False):
+        """
+        same as select_and_prefetch but each to-many relation is prefetched with a Prefetch object whose queryset
+        selects and prefetches the rest of the subtree itself. Hence foreign keys under a to-many relation are joined
+        in the prefetch query instead of being prefetched one level at a time. If use_only is True querysets of
+        Prefetch objects are also pruned with only().
+        """
+        select=[]
+        prefetch=[]
+        for child in self.children.values():
+            path=prefix+(child.accessor,)
+            if child.cached:
+                continue
+            if child.joined:
+                s,p=child.plan(path, use_only)
+                select+=s if s else ['__'.join(path)]
+                prefetch+=p
+            else:
+                prefetch.append(child.build_prefetch('__'.join(path), use_only))
+        return select, prefetch
+
+
+    def decide(self, strategy, depth=0, width=None):
+        """
+        asks strategy whether each to-one relation in the subtree is joined or prefetched. depth is the length of the
+        select_related chain this node is in and width is the estimated width of its rows. Returns the width after
+        the joins of the subtree.
+        """
+        for child in self.children.values():
+            if width is None:
+                width=strategy.row_width(child.field.model)
+            if child.edge.select:
+                joined_width=width+strategy.row_width(child.field.related_model)
+                child.joined=strategy.join(child.field, depth+1, joined_width)
+                if child.joined:
+                    width=child.decide(strategy, depth+1, joined_width)
+                    continue
+            # a prefetched relation starts a new query
+            child.decide(strategy)
+        return width
+
+
+    def cache(self, caches):
+        """
+        marks foreign keys to the models in caches(a RelationCaches) that nothing is accessed through. They are
+        filled from the cache after their parents are fetched instead of being joined or prefetched.
+        """
+        for child in self.children.values():
+            edge=child.edge
+            if edge.select and not edge.reverse and not child.children and edge.related_model in caches \
+                    and edge.field.target_field.primary_key:
+                child.cached=True
+                child.joined=False
+            else:
+                child.cache(caches)
+
+
+    def fill_paths(self, prefix=()):
+        """paths of the cached foreign keys that are filled on the instances of this node's queryset"""
+        res=[]
+        for child in self.children.values():
+            path=prefix+(child.accessor,)
+            if child.cached:
+                res.append('__'.join(path))
+            elif child.joined:
+                res+=child.fill_paths(path)
+        return res
+
+
+    def build_prefetch(self, lookup, use_only=False):
+        """returns a Prefetch object for this node whose queryset is optimized for the subtree of this node"""
+        if self.edge.generic:
+            return self.build_generic_prefetch(lookup, use_only)
+        select, prefetch=self.plan(use_only=use_only)
+        model=self.field.related_model
+        # django fetches to-one relations with the base manager, to-many relations with the default manager
+        queryset=(model._base_manager if self.edge.select else model._default_manager).all()
+        if select:
+            queryset=queryset.select_related(*select)
+        if prefetch:
+            queryset=queryset.prefetch_related(*prefetch)
+        if self.annotations:
+            queryset=queryset.annotate(**{name: pushed_down(model, expression) for name, expression in self.annotations.items()})
+        if use_only and not self.whole:
+            queryset=queryset.only(*self.only_columns())
+        fill_paths=self.fill_paths()
+        if fill_paths:
+            queryset=planned_queryset(queryset, fill_paths=fill_paths)
+        return Prefetch(lookup, queryset=queryset)
+
+
+    def build_generic_prefetch(self, lookup, use_only=False):
+        """
+        returns a prefetch of this GenericForeignKey. Related objects are fetched with one query per content type and
+        the queryset of each model in targets is planned for its serializer.
+        """
+        try:
+            # django>=5.0
+            from django.contrib.contenttypes.prefetch import GenericPrefetch
+        except ImportError:
+            GenericPrefetch=None
+        if not self.targets or GenericPrefetch is None:
+            return Prefetch(lookup)
+
+        from .plan import Plan
+        querysets=[Plan.from_serializer(serializer).apply(model._base_manager.all(), use_only=use_only)
+                   for model, serializer in self.targets.items()]
+        return GenericPrefetch(lookup, querysets)
+
+
+    def only_columns(self):
+        """columns of the prefetched model including the ones that django needs to join it to its parent"""
+        columns=set(self.columns)
+        model=self.field.related_model
+        columns.add(model._meta.pk.name)
+        # reverse foreign key is matched to parent instances through the foreign key column on the prefetched model
+        if isinstance(self.field, ManyToOneRel):
+            columns.add(self.field.field.name)
+        # generic relation is matched through the object id column and filtered by the content type column
+        if hasattr(self.field, 'object_id_field_name'):
+            columns.update((self.field.object_id_field_name, self.field.content_type_field_name))
+        return sorted(columns)
+
+
+    def prefetch_leaves(self, path):
+        if not self.children:
+            return ['__'.join(path)]
+        res=[]
+        for child in self.children.values():
+            res+=child.prefetch_leaves(path+(child.accessor,))
+        return res
+
+
+    @classmethod
+    def from_trails(cls, trails):
+        root=cls()
+        for trail in trails:
+            root.add(trail)
+        return root
+
+
 #given trails returned from Tracer.update method 
 #returns two sets first of which is arguments for select_related and second one is arguments to pass to prefetch_related 
-def optimized_queryset_given_trails(trails):
+def optimized_queryset_given_trails(trails, prefetch_objects=False, column_trails=None, strategy=None, aggregates=None, caches=None, generics=None):
     """
     given trails returned from Tracer.update method it returns two sets first of which 
-    is arguments for select_related and second one is arguments to pass to prefetch_related 
+    is arguments for select_related and second one is arguments to pass to prefetch_related.
+    Trails are merged into a relation trie first so that redundant arguments like 'a' when there is 'a__b' are not returned.
+    If prefetch_objects is True prefetch_related arguments are Prefetch objects with their own optimized querysets.
+    If column_trails which is a list of (trail, whole) pairs is given, querysets of Prefetch objects are also pruned with only().
+    Tracer.column_trails() returns them.
+    strategy is a JoinStrategy deciding whether to-one relations are joined, they are always joined if it is not given.
+    aggregates are (trail, annotation_name, expression) tuples returned from Tracer.aggregates(). They are annotated on
+    the querysets of Prefetch objects, the ones of the root queryset are not handled here.
+    Foreign keys to the models in caches(a RelationCaches) are left out, fill_paths_given_trails returns them.
+    generics are (trail, {model: serializer}) pairs of GenericForeignKeys that Tracer.generic_serializers returns.
     """
-    select=set()
-    prefetch=set()
-    for trail in trails:
-        s,p=select_and_prefetch(trail)
-        select.add(s)
-        prefetch.add(p)
-    
-    select.discard(''), prefetch.discard('')
-
-    return select, prefetch
+    root=RelationNode.from_trails(trails)
+    if strategy is not None:
+        root.decide(strategy)
+    if caches:
+        root.cache(caches)
+    for trail, name, expression in aggregates or ():
+        if not len(trail):
+            continue
+        node=root.find(trail)
+        # instances of a joined relation are not created by a queryset of their own, they cannot be annotated
+        if node is None or node.joined or node.cached:
+            logger.info('Aggregate {} cannot be pushed down, method will be called instead.'.format(name))
+            continue
+        node.annotations[name]=expression
+    for trail, serializers in generics or ():
+        node=root.find(trail)
+        if node is not None:
+            node.targets=serializers
+    if column_trails is not None:
+        for trail, whole in column_trails:
+            root.add_columns(trail, whole)
+    select, prefetch=root.plan(use_only=column_trails is not None) if prefetch_objects else root.select_and_prefetch()
+    return set(select), set(prefetch)
+
+
+def fill_paths_given_trails(trails, caches, strategy=None):
+    """returns paths of the cached foreign keys that are filled on the instances of the root queryset"""
+    root=RelationNode.from_trails(trails)
+    if strategy is not None:
+        root.decide(strategy)
+    root.cache(caches)
+    return root.fill_paths()
 
 
 class Tracer:
@@ -66,33 +365,55 @@ class Tracer:
     """
 
 
-    def __init__(self, serializer):
+    def __init__(self, serializer, from_class=False, fields=None):
         self.serializer=serializer
+        # if True sources are found from the class definition of the serializer without instantiating it
+        self.from_class=from_class
+        # requested fields like 'a,b.c'. Only their sources are traced if they are given
+        self.fields=fields_mask(normalize_fields(fields)) if fields is not None else None
+
+
+    def get_sources(self, include_pk=False, wholes=None):
+        """
+        all sources of the serializer including the ones learned at runtime. If wholes is a set, sources that need
+        the whole object they lead to are added to it.
+        """
+        sources=get_class_sources if self.from_class else get_all_sources
+        learned=learned_sources.get(self.serializer)
+        # learned sources are accessed by methods or properties which could read anything
+        if wholes is not None:
+            wholes.update(learned)
+        return sources(self.serializer, include_pk, self.fields, wholes)+learned
 
 
     def trace(self):
-        sources=get_all_sources(self.serializer)
+        sources=self.get_sources()
         trails=[]
         for source in sources:
-            trails.append(Trail(self.trace_source(source)))
+            trails.append(Trail(self.trace_edges(source)))
+        # same relations could be visited by more than one source, trails are interned hence duplicates are dropped cheaply
+        trails=list(dict.fromkeys(trails))
         self.trails=trails
         return trails 
     
     
     def trace_source(self, source, include_reverse=True):
-        """Traces a source like model.other_model.field and returns
+        """Traces a source like model.other_model.field and returns visited django fields
         """
+        return [edge.field for edge in self.trace_edges(source, include_reverse)]
+
+
+    def trace_edges(self, source, include_reverse=True):
+        """same as trace_source but returns edges of the relation graph"""
         serializer=self.serializer
         model=serializer.Meta.model
-        fields=Trail.get_model_accessors(model)
 
         trace=[]
         source=source.split('.')
         for each_field_name in source:
-            #find field by its name in fields
-            try:
-                field = [f for f in fields if f['accessor']==each_field_name][0]
-            except IndexError:
+            #find field by its name in fields of the model
+            edge=registry.edge(model, each_field_name)
+            if edge is None:
                 # NOTE: does not work with fields with source like 'get_xxx_display' eventhough django rest could handle them. 
                 # sources that includes get_xxx_display will still work since that field cannot be related. Hence not inluding 
                 # it in the trails will have no harm.
@@ -101,38 +422,89 @@ class Tracer:
                 logger.info('Source cannot be traced: {}. Hence it might not be fully optimized.'.format(source))
                 break
 
-            if include_reverse==False and isinstance(field['field'], ForeignObjectRel):
+            # reverse one to one relations are joined, only() accepts their columns like 'student__text'
+            if include_reverse==False and edge.reverse and not edge.select:
                 break
 
-            trace.append(field['field'])
-            
-            #TODO: does it support GenericForeignKeys ?
-            if not(isinstance(field['field'], ForeignObjectRel) or isinstance(field['field'], DjangoRelatedField)):
+            trace.append(edge)
+
+            # model of a GenericForeignKey is known per instance, GenericRelatedField traces the rest for each model
+            if edge.generic:
+                break
+            if not edge.is_relation:
                 # if it is not a related or reverse related field than trail is done. Source should finish here as well
                 # if it does not it should give an attribute error anyway. Maybe it should be checked to see possible errors
                 break
             else:
-                fields=Trail.get_model_accessors(field['field'].related_model)
+                model=edge.related_model
 
         return trace
 
 
-    #same as trace method but this do not include reverse related fields. It is useful to decide what to pass to only() since
-    #it does not support reverse relations
+    def aggregates(self):
+        """
+        returns (trail, annotation_name, expression) of the MethodFields with aggregates. Trail leads to the relation whose
+        instances are annotated, it is empty for the serializer itself. Sources that cannot be fully traced are skipped.
+        """
+        res=[]
+        for source, name, expression in get_aggregates(self.serializer, self.from_class, self.fields):
+            edges=self.trace_edges(source) if source else []
+            if source and len(edges)!=len(source.split('.')):
+                logger.info('Source cannot be traced: {}. Aggregate {} will not be pushed down.'.format(source, name))
+                continue
+            res.append((Trail(edges), name, expression))
+        return res
+
+
+    def generic_serializers(self):
+        """returns (trail, {model: serializer}) of the GenericRelatedFields whose sources could be fully traced"""
+        res=[]
+        for source, serializers in get_generic_serializers(self.serializer, self.from_class, self.fields):
+            edges=self.trace_edges(source)
+            if len(edges)!=len(source.split('.')) or not edges[-1].generic:
+                logger.info('Source cannot be traced: {}. It is not a generic foreign key.'.format(source))
+                continue
+            res.append((Trail(edges), serializers))
+        return res
+
+
+    #same as trace method but this do not include reverse related fields other than one to one. It is useful to decide what to
+    #pass to only() since it does not support reverse to-many relations
     def eliminate_reverse(self):
-        sources=get_all_sources(self.serializer, include_pk=True)
+        sources=self.get_sources(include_pk=True)
         trails=[]
         for source in sources:
-            t=self.trace_source(source, include_reverse=False)
+            t=self.trace_edges(source, include_reverse=False)
             if len(t)==0: continue
             trails.append(Trail(t))
         return trails 
 
 
+    def column_trails(self):
+        """
+        Returns trails of all sources including primary key related fields as (trail, whole) pairs. Whole is True for the sources
+        of the fields that render the whole object, like a StringRelatedField. It is decided per field, a relation is still
+        whole if another field nests a serializer on it. They are used to decide what to pass to only() of prefetched querysets.
+        """
+        wholes=set()
+        sources=self.get_sources(include_pk=True, wholes=wholes)
+        return [(Trail(self.trace_edges(source)), source in wholes) for source in sources]
+
+
     #method that returns what to pass to only()
     def build_only(self):
         trails=self.eliminate_reverse()
-        return [trail.get_as_source().replace('.','__') for trail in trails]
+        res=[]
+        for trail in trails:
+            source=trail.get_as_source('__')
+            edge=trail.edges[-1]
+            # only() does not accept a GenericForeignKey, the columns it is loaded from are passed instead
+            if edge.generic:
+                prefix=source[:-len(edge.accessor)]
+                res+=[prefix+edge.field.ct_field, prefix+edge.field.fk_field]
+            else:
+                res.append(source)
+        return res
 
 
 
@@ -149,47 +521,91 @@ class Trail:
 
     Here we visit Parent, Child and Toy models hence we need to prefetch all of them. Trail helps us to decide what to prefetch or select
     by examining visited fields. A onetoone field leads to select_related while a manytomany or reverse_related fields requires prefetch_related
+
+    Trail is an immutable value. Fields are kept as edges of the relation graph and their accessors, select_related prefix and
+    prefetch_related path are computed once when it is created. Trails of the same edges are the same object, hence they are
+    cheap to compare and could be used in sets and as dict keys.
     """
-    def __init__(self, fields):
-        self.fields=fields
-    
+    __slots__=('edges', 'fields', 'accessors', 'select', 'prefetch', '_hash', '__weakref__')
+    _interned=WeakValueDictionary()
+    _lock=Lock()
+
+    def __new__(cls, fields):
+        edges=tuple(f if isinstance(f, Edge) else registry.edge_of(f) for f in fields)
+        trail=cls._interned.get(edges)
+        if trail is not None:
+            return trail
+
+        trail=super().__new__(cls)
+        accessors=tuple(edge.accessor for edge in edges)
+        setattr_=super(Trail, trail).__setattr__
+        setattr_('edges', edges)
+        setattr_('fields', tuple(edge.field for edge in edges))
+        setattr_('accessors', accessors)
+        setattr_('_hash', hash(edges))
+        # leading to-one relations are joined, the path is prefetched from the first to-many relation to the last relation
+        select=[]
+        prefetch=[]
+        for edge in edges:
+            if edge.select:
+                select.append(edge.accessor)
+                continue
+            if edge.is_relation:
+                prefetch=[each.accessor for each in edges if each.is_relation]
+            break
+        setattr_('select', '__'.join(select))
+        setattr_('prefetch', '__'.join(prefetch))
+        with cls._lock:
+            return cls._interned.setdefault(edges, trail)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Trail is immutable')
+
 
     @staticmethod
     def get_accessor(field):
         if isinstance(field, SerializerMethodField):
             raise Exception('SerializerMethodField has no accessor')
-        #ForeignObjectRel instances have this attribute. returns default name like 'parent_set' or related_name if it is set 
-        if hasattr(field, 'get_accessor_name'):
-            return field.get_accessor_name()
-        else:
-            #NOTE: there is also field.attname. It might be more appropriate 
-            return field.name
+        return registry.edge_of(field).accessor
     
 
     @staticmethod
-    @lru_cache(maxsize=20, typed=True) # Since this function will very likely be called more than once with the same model caching it makes sense.
     def get_model_accessors(model):
         """
             given django model instance it returns all of its fields with its accessor(just like trail object)
             including related and reverse related fields like;
             [{'field':field_instance, 'accessor':'parent'}, {'field':field_instance, 'accessor':'child_set'}]
         """
-        res=[]
-        for f in model._meta.get_fields():
-            res.append({'field':f, 'accessor':Trail.get_accessor(f)})
-        return res
+        return [Trail.as_dict(edge) for edge in registry.edges(model).values()]
+
+
+    @staticmethod
+    def as_dict(edge):
+        return {'field':edge.field, 'accessor':edge.accessor, 'edge':edge}
 
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            indices = range(*key.indices(len(self.fields)))
-            return [{'field':self.fields[i], 'accessor': Trail.get_accessor(self.fields[i])} for i in indices]
-        return {'field':self.fields[key], 'accessor': Trail.get_accessor(self.fields[key])}
+            return [Trail.as_dict(edge) for edge in self.edges[key]]
+        return Trail.as_dict(self.edges[key])
     
     
+    def __len__(self):
+        return len(self.edges)
+
+
+    def __eq__(self, other):
+        return self is other or isinstance(other, Trail) and self.edges==other.edges
+
+
+    def __hash__(self):
+        return self._hash
+
+
     def __repr__(self):
-        return str(self.fields)
+        return 'Trail({})'.format('.'.join(self.accessors))
     
     
     def get_as_source(self, seperator='.'):
-        return seperator.join([Trail.get_accessor(f) for f in self.fields])
+        return seperator.join(self.accessors)
@@ -1,28 +1,47 @@
 from rest_framework.relations import (
     ManyRelatedField,
     PrimaryKeyRelatedField,
-    HyperlinkedRelatedField
+    HyperlinkedRelatedField,
+    HyperlinkedIdentityField,
+    SlugRelatedField,
 )
-from rest_framework.serializers import BaseSerializer, ListSerializer
+from rest_framework.serializers import (
+    BaseSerializer, 
+    ListSerializer, 
+    ModelSerializer, 
+    HyperlinkedModelSerializer, 
+    ALL_FIELDS,
+)
+from rest_framework.settings import api_settings
 from inspect import isclass
 
+from .fragments import representation_sources
+from .sparse import honors_fields_mask
+
 import logging
 logger = logging.getLogger("django-auto-related")
 
 """
 NOTE:
 HyperlinkedIdentityFields' source is also * like SerializerMethodField. 
-Since HyperlinkedIdentityField uses field of the object itself it may not need optimization other than only() and defer()
+Since HyperlinkedIdentityField uses field of the object itself it does not need optimization other than only() and defer(),
+its lookup_field is a source so that it is not deferred.
 """
 
 
 #TODO: When used with primarykeyrelated field it does not include source field or pk 
 #pk may be included but when accesing a models field pk is not listed there. So some changes are required to do that
 
-#TODO:HyperlinkedRelatedField uses pk as default but can access to other fields of a model with a different lookup_key parameter that requires a db hit.
+#NOTE: HyperlinkedRelatedField with a lookup_field other than pk and SlugRelatedField read one column of the related model. Their sources
+#are followed by that column hence the related model is joined or prefetched and pruned down to it by only().
 
 #NOTE: if output of this will be given to only or defer then reverse relations other than onetoone should be removed(django doesnt support it)
-def get_all_sources(serializer, include_pk=False):
+def get_all_sources(serializer, include_pk=False, fields=None, wholes=None):
+    # fields is a mask like {'a': None, 'b': {'c': None}} built by auto_related.sparse.fields_mask. If it is given only the
+    # sources of the requested fields are returned. None means all fields. It is ignored by serializers that render all
+    # of their fields anyway.
+    # If wholes is a set, sources of the fields that render the whole object of their source are added to it.
+    mask=fields if honors_fields_mask(serializer) else None
     #if it is class get instance, if it is instance leave as is.
     serializer=serializer() if isclass(serializer) else serializer
     try:
@@ -34,48 +53,307 @@ def get_all_sources(serializer, include_pk=False):
     
     res=[]
     for key in fields:
+        if mask is not None and key not in mask:
+            continue
         field=fields[key]
         source=field.source if field.source is not None else field.name
-        
-        #if it is SerializerMethodField
-        if source == '*':
-            if hasattr(field, '_auto_related_sources'):
-                res+=field._auto_related_sources
+        res+=field_sources(field, source, include_pk, get_all_sources, mask[key] if mask is not None else None, wholes)
+
+    # version column of a serializer with cached representations is read even if it is not a field
+    res+=representation_sources(serializer.child if isinstance(serializer, ListSerializer) else serializer)
+    return res
+
+
+def field_sources(field, source, include_pk, get_nested_sources, fields=None, wholes=None):
+    """
+    returns sources of a serializer field whose source is given. Sources of nested serializers are
+    obtained with get_nested_sources(nested_serializer, include_pk, fields, wholes) and prefixed with source.
+    """
+    #if it is SerializerMethodField
+    if source == '*':
+        # HyperlinkedIdentityField reads its lookup field from the object itself
+        if isinstance(field, HyperlinkedIdentityField) and field.lookup_field!='pk':
+            return [field.lookup_field]
+        sources=list(getattr(field, '_auto_related_sources', []))
+        # a method could do anything with the objects of its sources
+        if wholes is not None:
+            wholes.update(sources)
+        return sources
+
+    # if it is a many related_field get child relation for below isintance checks to work since ManyRelatedField is not subclass of them they are useless if we dont get child_relation
+    # Child relation will have the same source so there is no problem there
+    if isinstance(field, ManyRelatedField):
+        field=field.child_relation
+        # pks of a to-many relation are not columns of the instance, related objects are queried to get them
+        include_pk=True
+
+    #This is a special case. Normally source of a primarykey related field is not used while serializing but pk value is used
+    #hence no need to prefetch related model when using primary key related field
+    if isinstance(field, PrimaryKeyRelatedField) and include_pk==False:
+        return []
+
+    # Another special case
+    # HyperlinkedRelatedField uses pk only optimization like PrimaryKeyRelatedField if lookup_field is 'pk' which is its default
+    if isinstance(field, HyperlinkedRelatedField):
+        if field.lookup_field=='pk':
+            if include_pk==False:
+                return []
+        else:
+            source+='.{}'.format(str(field.lookup_field))
+
+    # only the slug column of the related model is read
+    if isinstance(field, SlugRelatedField):
+        source+='.{}'.format(field.slug_field)
+
+    res=[source]
+    if isinstance(field, (BaseSerializer)):
+        recursing=field.child if isinstance(field, ListSerializer) else field
+        nested_wholes=set() if wholes is not None else None
+        res+=[source+'.'+each_source for each_source in get_nested_sources(recursing, include_pk, fields, nested_wholes)]
+        if wholes is not None:
+            wholes.update(source+'.'+each_source for each_source in nested_wholes)
+    # a nested serializer reads only its fields and the related fields above read a pk or a column. Others like
+    # StringRelatedField render the object of their source as a whole.
+    elif wholes is not None and not isinstance(field, (PrimaryKeyRelatedField, HyperlinkedRelatedField, SlugRelatedField)):
+        wholes.add(source)
+    return res
+
+
+def get_class_sources(serializer, include_pk=False, fields=None, wholes=None):
+    """
+    Same as get_all_sources but works on the class definition of a serializer without instantiating it. Declared fields
+    are read from _declared_fields and fields that ModelSerializer would build are resolved from Meta.fields, Meta.exclude
+    and Meta.depth against the model. Hence fields of nested ModelSerializers are not built at all. Serializers that change
+    their fields in __init__ or get_fields should be traced with get_all_sources instead.
+    """
+    serializer_class=serializer if isclass(serializer) else type(serializer.child if isinstance(serializer, ListSerializer) else serializer)
+    fields=fields if honors_fields_mask(serializer_class) else None
+    declared=getattr(serializer_class, '_declared_fields', {})
+    meta=getattr(serializer_class, 'Meta', None)
+    model=getattr(meta, 'model', None)
+
+    if not issubclass(serializer_class, ModelSerializer) or model is None:
+        names=list(declared)
+    else:
+        names=model_field_names(serializer_class, declared, model)
+
+    depth=getattr(meta, 'depth', 0)
+    hyperlinked=issubclass(serializer_class, HyperlinkedModelSerializer)
+    res=[]
+    for name in names:
+        if fields is not None and name not in fields:
             continue
-        
-        # if it is a many related_field get child relation for below isintance checks to work since ManyRelatedField is not subclass of them they are useless if we dont get child_relation
-        # Child relation will have the same source so there is no problem there
-        if isinstance(field, ManyRelatedField):
-            field=field.child_relation
-
-        #This is a special case. Normally source of a primarykey related field is not used while serializing but pk value is used
-        #hence no need to prefetch related model when using primary key related field
-        if isinstance(field, PrimaryKeyRelatedField) and include_pk==False:
+        nested=fields[name] if fields is not None else None
+        if name in declared:
+            field=declared[name]
+            res+=field_sources(field, field.source if field.source is not None else name, include_pk, get_class_sources, nested, wholes)
+        else:
+            res+=implicit_field_sources(model, name, depth, hyperlinked, include_pk, nested)
+    res+=representation_sources(serializer_class)
+    return res
+
+
+def model_field_names(serializer_class, declared, model):
+    """returns names of the fields that ModelSerializer.get_field_names would return"""
+    fields=getattr(serializer_class.Meta, 'fields', None)
+    exclude=getattr(serializer_class.Meta, 'exclude', None)
+    if fields is not None and fields!=ALL_FIELDS:
+        return list(fields)
+
+    opts=model._meta
+    first=api_settings.URL_FIELD_NAME if issubclass(serializer_class, HyperlinkedModelSerializer) else opts.pk.name
+    names=[first]+list(declared)+default_model_field_names(model)
+    # declared fields are listed twice when they override a model field, first one wins like in rest framework
+    return [name for name in dict.fromkeys(names) if name not in (exclude or ())]
+
+
+def default_model_field_names(model):
+    """non pk model fields and forward relations of a model just like rest framework's model_meta"""
+    opts=model._meta
+    return [f.name for f in opts.fields if f.serialize and not f.remote_field]+\
+           [f.name for f in opts.fields if f.serialize and f.remote_field]+\
+           [f.name for f in opts.many_to_many if f.serialize]
+
+
+def implicit_field_sources(model, name, depth, hyperlinked, include_pk, fields=None):
+    """returns sources of a field that is not declared but built by ModelSerializer"""
+    from .registry import registry
+
+    # url field of HyperlinkedModelSerializer is a HyperlinkedIdentityField whose source is '*'
+    if hyperlinked and name==api_settings.URL_FIELD_NAME:
+        return []
+
+    field=registry.get_field(model, name)
+    if field is None or field.related_model is None:
+        # model field or a property/method which rest framework serializes with ReadOnlyField
+        return [name]
+
+    if depth>0:
+        # nested serializers built for depth render all of their fields whatever is requested
+        nested=[name+'.'+each_source for each_source in nested_model_sources(field.related_model, depth-1, hyperlinked, include_pk)]
+        return [name]+nested
+
+    # relations are PrimaryKeyRelatedField or HyperlinkedRelatedField with pk lookup when depth is 0.
+    # pks of a to-many relation are queried hence it is prefetched anyway
+    return [name] if include_pk or field.many_to_many or field.one_to_many else []
+
+
+def nested_model_sources(model, depth, hyperlinked, include_pk, fields=None):
+    """sources of the nested serializer ModelSerializer.build_nested_field builds for depth option"""
+    names=([] if hyperlinked else [model._meta.pk.name])+default_model_field_names(model)
+    res=[]
+    for name in names:
+        if fields is not None and name not in fields:
+            continue
+        res+=implicit_field_sources(model, name, depth, hyperlinked, include_pk, fields[name] if fields is not None else None)
+    return res
+
+
+def get_aggregates(serializer, from_class=False, fields=None):
+    """
+    returns (source, annotation_name, expression) of MethodFields with an aggregate in the serializer and its nested
+    serializers. source is the source of the nested serializer whose instances should be annotated, '' for the serializer itself.
+    """
+    from .method_field import annotation_name
+
+    mask=fields if honors_fields_mask(serializer) else None
+    if from_class:
+        serializer_class=serializer if isclass(serializer) else type(serializer.child if isinstance(serializer, ListSerializer) else serializer)
+        serializer_fields=getattr(serializer_class, '_declared_fields', {})
+    else:
+        serializer=serializer() if isclass(serializer) else serializer
+        try:
+            serializer_fields=serializer.child.fields if isinstance(serializer, ListSerializer) else serializer.fields
+        except AttributeError:
+            return []
+
+    res=[]
+    for name, field in serializer_fields.items():
+        if mask is not None and name not in mask:
             continue
+        if getattr(field, 'aggregate', None) is not None:
+            res.append(('', annotation_name(name), field.aggregate))
+        elif isinstance(field, BaseSerializer):
+            source=field.source if field.source is not None else name
+            nested=field.child if isinstance(field, ListSerializer) else field
+            res+=[(source+'.'+each if each else source, each_name, expression)
+                  for each, each_name, expression in get_aggregates(nested, from_class, mask[name] if mask is not None else None)]
+    return res
 
-        # Another special case
-        # HyperlinkedRelatedField uses pk only optimization like PrimaryKeyRelatedField if lookup_field is 'pk' which is its default
-        if isinstance(field, HyperlinkedRelatedField):
-            if field.lookup_field=='pk':
-                if include_pk==False:
-                    continue
-            else:
-                source+='.{}'.format(str(field.lookup_field))
 
-        res.append(source)
-        if isinstance(field, (BaseSerializer)):
-            recursing=field.child if isinstance(field, ListSerializer) else field
-            res+=[source+'.'+each_source for each_source in get_all_sources(recursing, include_pk)]
+def get_generic_serializers(serializer, from_class=False, fields=None):
+    """
+    returns (source, {model: serializer}) of GenericRelatedFields in the serializer and its nested serializers.
+    Sources are relative to the serializer.
+    """
+    from .generic import GenericRelatedField
 
+    mask=fields if honors_fields_mask(serializer) else None
+    if from_class:
+        serializer_class=serializer if isclass(serializer) else type(serializer.child if isinstance(serializer, ListSerializer) else serializer)
+        serializer_fields=getattr(serializer_class, '_declared_fields', {})
+    else:
+        serializer=serializer() if isclass(serializer) else serializer
+        try:
+            serializer_fields=serializer.child.fields if isinstance(serializer, ListSerializer) else serializer.fields
+        except AttributeError:
+            return []
+
+    res=[]
+    for name, field in serializer_fields.items():
+        if mask is not None and name not in mask:
+            continue
+        source=field.source if field.source is not None else name
+        if isinstance(field, GenericRelatedField):
+            # serializers of an unbound field are not instantiated yet
+            serializers=getattr(field, 'bound', None) or {model: each() if isclass(each) else each for model, each in field.serializers.items()}
+            res.append((source, serializers))
+        elif isinstance(field, BaseSerializer):
+            nested=field.child if isinstance(field, ListSerializer) else field
+            res+=[(source+'.'+each, serializers)
+                  for each, serializers in get_generic_serializers(nested, from_class, mask[name] if mask is not None else None)]
     return res
 
 
+class LearnedSources:
+    """
+    Sources of serializers that could not be found by inspecting them but are observed at runtime, for example
+    relations accessed in a SerializerMethodField without sources. Tracer adds them to the sources of a serializer.
+    """
+    def __init__(self):
+        self._sources={}
+
+
+    def add(self, serializer, source):
+        """returns True if source is not known before"""
+        sources=self._sources.setdefault(serializer if isclass(serializer) else type(serializer), [])
+        if source in sources:
+            return False
+        sources.append(source)
+        return True
+
+
+    def get(self, serializer):
+        return list(self._sources.get(serializer if isclass(serializer) else type(serializer), ()))
+
+
+    def clear(self):
+        self._sources.clear()
+
+
+learned_sources=LearnedSources()
+
+
+def iterate_in_chunks(queryset, chunk_size):
+    """
+    Yields instances of queryset in lists of chunk_size. Prefetch lookups of the queryset are applied to each chunk 
+    separately with prefetch_related_objects so that memory stays flat while n+1 problem does not come back.
+    """
+    from django.db.models import prefetch_related_objects
+    from .cache import fill_relations
+    from .queryset import batched_prefetch_related_objects, share_instances
+
+    lookups=queryset._prefetch_related_lookups
+    # IN clauses of a planned queryset with a batch size stay bounded in a chunk too
+    batch_size=getattr(queryset, 'prefetch_batch_size', None)
+    def prefetch(chunk):
+        if batch_size is not None:
+            batched_prefetch_related_objects(chunk, lookups, batch_size)
+        else:
+            prefetch_related_objects(chunk, *lookups)
+
+    # foreign keys of a planned queryset that are filled from relation caches
+    fill_paths=getattr(queryset, 'fill_paths', ())
+    # instances are shared in a chunk, not across chunks
+    identity_map=getattr(queryset, 'identity_map', False)
+    chunk=[]
+    for obj in queryset.prefetch_related(None).iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk)==chunk_size:
+            prefetch(chunk)
+            fill_relations(chunk, fill_paths)
+            if identity_map:
+                share_instances(chunk)
+            yield chunk
+            chunk=[]
+    if chunk:
+        prefetch(chunk)
+        fill_relations(chunk, fill_paths)
+        if identity_map:
+            share_instances(chunk)
+        yield chunk
+
+
 def patch_cursor():
     """
     when called in django environment it patches django cursor object
     so that on each db hit it prints how many queries executed. 
     Useful to detect n+1 problems but should not be used in production. 
+
+    Deprecated: use auto_related.instrumentation.QueryRecorder or QueryInstrumentationMiddleware instead.
     """
+    import warnings
+    warnings.warn('patch_cursor is deprecated, use auto_related.instrumentation.QueryRecorder instead.', DeprecationWarning, stacklevel=2)
     from django.db import connection as c
     old_execute= c.cursor().__class__.execute
     old_callproc= c.cursor().__class__.callproc
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from threading import Lock
+
+from django.db.models.fields.related import ForeignKey, OneToOneField
+from rest_framework.fields import Field, SerializerMethodField
+from rest_framework.response import Response
+from rest_framework.relations import PKOnlyObject, PrimaryKeyRelatedField, RelatedField, ManyRelatedField
+from rest_framework.serializers import BaseSerializer, ListSerializer, Serializer
+
+from .tracer import Tracer
+
+import logging
+logger = logging.getLogger("django-auto-related")
+
+
+class ValuesNotSupported(Exception):
+    """raised when a serializer cannot be serialized from queryset.values() rows"""
+    pass
+
+
+class ValuesSerializer:
+    """
+    Serializes rows returned by queryset.values() with the fields of a serializer. Models are not instantiated
+    and get_attribute of fields are not called, values are read directly from the rows by their column names.
+
+    It only supports serializers whose fields are plain model fields, PrimaryKeyRelatedFields of foreign keys and
+    nested serializers of foreign keys or one to one fields. Otherwise ValuesNotSupported is raised.
+    """
+    def __init__(self, serializer):
+        serializer=serializer.child if isinstance(serializer, ListSerializer) else serializer
+        self.tracer=Tracer(serializer)
+        self.columns=[]
+        self.entries=self.compile(serializer, ())
+
+
+    def compile(self, serializer, prefix):
+        """returns a list of (field_name, field, column, children) entries for fields of the serializer"""
+        if type(serializer).to_representation is not Serializer.to_representation:
+            raise ValuesNotSupported('{} overrides to_representation'.format(type(serializer).__name__))
+
+        entries=[]
+        for field in serializer._readable_fields:
+            if isinstance(field, (SerializerMethodField, ManyRelatedField, ListSerializer)) or field.source=='*':
+                raise ValuesNotSupported('{} of {} is not supported'.format(field.field_name, type(serializer).__name__))
+
+            path=prefix+tuple(field.source_attrs)
+            trail=self.tracer.trace_source('.'.join(path))
+            # every part of the source should be a model field and all parts but the last should be forward to-one relations
+            if len(trail)!=len(path) or not all(isinstance(f, (ForeignKey, OneToOneField)) for f in trail[:-1]):
+                raise ValuesNotSupported('source of {} cannot be read from values()'.format(field.field_name))
+            last=trail[-1]
+            column='__'.join(path)
+
+            if isinstance(field, BaseSerializer):
+                if not isinstance(last, (ForeignKey, OneToOneField)):
+                    raise ValuesNotSupported('{} is not a to-one relation'.format(field.field_name))
+                # pk of the related model tells if the relation is null
+                pk_column=column+'__'+last.related_model._meta.pk.name
+                self.add_column(pk_column)
+                entries.append((field.field_name, field, pk_column, self.compile(field, path)))
+            elif isinstance(field, RelatedField):
+                if not isinstance(field, PrimaryKeyRelatedField) or not isinstance(last, (ForeignKey, OneToOneField)) \
+                        or type(field).get_attribute is not RelatedField.get_attribute:
+                    raise ValuesNotSupported('{} is not a primary key related field of a foreign key'.format(field.field_name))
+                # values() returns pk of the related model for a foreign key
+                self.add_column(column)
+                entries.append((field.field_name, field, column, None))
+            else:
+                if last.is_relation or not last.concrete or type(field).get_attribute is not Field.get_attribute:
+                    raise ValuesNotSupported('{} is not a concrete model field'.format(field.field_name))
+                self.add_column(column)
+                entries.append((field.field_name, field, column, None))
+        return entries
+
+
+    def add_column(self, column):
+        # pk of a nested serializer is usually one of its fields as well
+        if column not in self.columns:
+            self.columns.append(column)
+
+
+    def to_representation(self, row, entries=None):
+        ret=OrderedDict()
+        for field_name, field, column, children in (self.entries if entries is None else entries):
+            value=row[column]
+            if value is None:
+                ret[field_name]=None
+            elif children is not None:
+                ret[field_name]=self.to_representation(row, children)
+            elif isinstance(field, PrimaryKeyRelatedField):
+                ret[field_name]=field.to_representation(PKOnlyObject(pk=value))
+            else:
+                ret[field_name]=field.to_representation(value)
+        return ret
+
+
+    def serialize(self, queryset):
+        """evaluates queryset with values() and returns serialized data as a list"""
+        # select_related and prefetch_related are useless for values() since it joins the related columns itself
+        rows=queryset.select_related(None).prefetch_related(None).values(*self.columns)
+        return self.serialize_rows(rows)
+
+
+    def serialize_rows(self, rows):
+        return [self.to_representation(row) for row in rows]
+
+
+class ValuesViewMixin:
+    """
+    List view mixin which serializes the queryset from values() rows instead of model instances when the serializer
+    is supported by ValuesSerializer. It falls back to the normal serialization otherwise. It is meant for read only
+    list endpoints and can be combined with ViewMixin.
+    """
+    # requested fields come from clients, hence least recently used values serializers are dropped like plans.
+    # Each view class has its own cache.
+    values_cache_size=1024
+    _values_serializers=None
+    _values_lock=Lock()
+
+    @classmethod
+    def get_values_cache(cls):
+        with cls._values_lock:
+            # a cache inherited from a parent view class is not used
+            cache=cls.__dict__.get('_values_serializers')
+            if cache is None:
+                cache=cls._values_serializers=OrderedDict()
+        return cache
+
+
+    def get_values_serializer(self):
+        key=(self.get_serializer_class(), self.get_plan_key() if hasattr(self, 'get_plan_key') else None,
+             self.get_requested_fields() if hasattr(self, 'get_requested_fields') else None)
+        cache=self.get_values_cache()
+        with self._values_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        try:
+            values_serializer=ValuesSerializer(self.get_serializer())
+        except ValuesNotSupported as e:
+            logger.info('values() cannot be used for {}: {}'.format(key[0].__name__, e))
+            values_serializer=None
+        with self._values_lock:
+            values_serializer=cache.setdefault(key, values_serializer)
+            while len(cache)>self.values_cache_size:
+                cache.popitem(last=False)
+        return values_serializer
+
+
+    def list(self, request, *args, **kwargs):
+        values_serializer=self.get_values_serializer()
+        if values_serializer is None:
+            return super().list(request, *args, **kwargs)
+
+        queryset=self.filter_queryset(self.get_queryset())
+        queryset=queryset.select_related(None).prefetch_related(None).values(*values_serializer.columns)
+
+        page=self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(values_serializer.serialize_rows(page))
+        return Response(values_serializer.serialize_rows(queryset))
@@ -0,0 +1,49 @@
+import random
+
+from testerapp.models import Parent, Child, ChildChild, Teacher, Course, Student
+from benchmarks.models import Tag, LEVELS
+
+
+def parents(rows, fanout):
+    """creates rows parents, each child is shared by fanout parents and each childchild by fanout children"""
+    childchilds=ChildChild.objects.bulk_create([ChildChild(text='childchild {}'.format(i)) for i in range(max(rows//fanout**2, 1))])
+    children=Child.objects.bulk_create([
+        Child(text='child {}'.format(i), child=childchilds[i%len(childchilds)]) for i in range(max(rows//fanout, 1))
+    ])
+    Parent.objects.bulk_create([Parent(text='parent {}'.format(i), child=children[i%len(children)]) for i in range(rows)])
+
+
+def courses(rows, fanout, seed=0):
+    """creates rows courses, each with fanout teachers and fanout students on average"""
+    rnd=random.Random(seed)
+    courses=Course.objects.bulk_create([Course(text='course {}'.format(i)) for i in range(rows)])
+    teachers=Teacher.objects.bulk_create([
+        Teacher(text='teacher {}'.format(i), big_text_field='x'*4096) for i in range(max(rows*fanout//4, 1))
+    ])
+    students=Student.objects.bulk_create([Student(text='student {}'.format(i)) for i in range(max(rows*fanout//4, 1))])
+    Teacher.teaches.through.objects.bulk_create([
+        Teacher.teaches.through(teacher=teacher, course=course)
+        for course in courses for teacher in rnd.sample(teachers, min(fanout, len(teachers)))
+    ])
+    Student.courses.through.objects.bulk_create([
+        Student.courses.through(student=student, course=course)
+        for course in courses for student in rnd.sample(students, min(fanout, len(students)))
+    ])
+
+
+def levels(rows, fanout, tags_per_row=2, seed=0):
+    """creates rows Level0 instances, every level has rows//fanout**level instances and tags_per_row tags on each"""
+    rnd=random.Random(seed)
+    tags=Tag.objects.bulk_create([Tag(text='tag {}'.format(i)) for i in range(max(rows//fanout, tags_per_row))])
+    above=None
+    for level, model in reversed(list(enumerate(LEVELS))):
+        count=max(rows//fanout**level, 1)
+        values={'f{}'.format(i): '{} {}'.format(model.__name__, i) for i in range(10)}
+        objs=model.objects.bulk_create([
+            model(up=above[i%len(above)], **values) if above is not None else model(**values) for i in range(count)
+        ])
+        model.tags.through.objects.bulk_create([
+            model.tags.through(**{model.__name__.lower(): obj, 'tag': tag})
+            for obj in objs for tag in rnd.sample(tags, tags_per_row)
+        ])
+        above=objs
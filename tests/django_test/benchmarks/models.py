@@ -0,0 +1,26 @@
+from django.db import models
+
+# Synthetic graph used to measure tracing and queries against deeper and wider serializers than the ones in testerapp.
+# Level0.up -> Level1.up -> ... -> Level4 and every level has many to many tags.
+# There are no migrations for these models, tables are created with migrate --run-syncdb.
+
+WIDTH = 10
+DEPTH = 5
+
+
+class Tag(models.Model):
+    text=models.TextField()
+
+
+def level_model(level):
+    attrs={'__module__': __name__}
+    for i in range(WIDTH):
+        attrs['f{}'.format(i)]=models.TextField(default='')
+    if level<DEPTH-1:
+        attrs['up']=models.ForeignKey('Level{}'.format(level+1), on_delete=models.CASCADE, null=True, related_name='downs')
+    attrs['tags']=models.ManyToManyField(Tag, related_name='level{}_set'.format(level))
+    return type('Level{}'.format(level), (models.Model,), attrs)
+
+
+LEVELS=[level_model(level) for level in range(DEPTH)]
+Level0, Level1, Level2, Level3, Level4 = LEVELS
@@ -0,0 +1,147 @@
+"""
+Benchmark suite of auto_related. It measures;
+
+  - tracing: time of Tracer.trace, Tracer.build_only, optimized_queryset_given_trails and Plan.from_serializer
+    against width and depth of synthetic serializers
+  - queries: query count, wall time and peak memory of serializing a queryset without any optimization(slow),
+    with ViewMixin plan and with ViewMixinWithOnlyOptim plan
+
+Results are written as json so that they could be compared between releases. Run it from tests/django_test;
+
+    $ python -m benchmarks --rows 1000 --fanout 5 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django
+django.setup()
+
+from django.core.management import call_command
+import rest_framework
+
+from auto_related.instrumentation import QueryRecorder
+from auto_related.plan import Plan
+from auto_related.tracer import Tracer, optimized_queryset_given_trails
+from benchmarks import fixtures
+from benchmarks.models import DEPTH, WIDTH
+from benchmarks.serializers import level_serializer
+from testerapp import serializers as tester_serializers
+
+
+def best_of(fn, repeat, number):
+    """returns best average time of fn in seconds"""
+    return min(timeit.repeat(fn, repeat=repeat, number=number))/number
+
+
+def tracing(widths, depths, repeat, number):
+    results=[]
+    for depth in depths:
+        for width in widths:
+            serializer_class=level_serializer(width, depth)
+            tracer=Tracer(serializer_class())
+            trails=tracer.trace()
+            results.append({
+                'serializer': serializer_class.__name__,
+                'width': width,
+                'depth': depth,
+                'trace': best_of(lambda: Tracer(serializer_class()).trace(), repeat, number),
+                'trace_from_class': best_of(lambda: Tracer(serializer_class, from_class=True).trace(), repeat, number),
+                'build_only': best_of(tracer.build_only, repeat, number),
+                'optimized_queryset_given_trails': best_of(lambda: optimized_queryset_given_trails(trails), repeat, number),
+                'plan': best_of(lambda: Plan.from_serializer(serializer_class()), repeat, number),
+            })
+    return results
+
+
+def measure(serializer_class, queryset):
+    """
+    serializes queryset and returns query count, wall time and peak memory of it. Memory is measured in a
+    second run since tracemalloc slows down the code it traces.
+    """
+    with QueryRecorder(callback=lambda stats: None) as recorder:
+        start=perf_counter()
+        serializer_class(queryset.all(), many=True).data
+        duration=perf_counter()-start
+
+    tracemalloc.start()
+    serializer_class(queryset.all(), many=True).data
+    _, peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'queries': recorder.stats.count,
+        'duplicate_queries': sum(recorder.stats.duplicates.values()),
+        'query_time': recorder.stats.duration,
+        'time': duration,
+        'peak_memory': peak,
+    }
+
+
+def queries(serializer_classes):
+    results=[]
+    for serializer_class in serializer_classes:
+        model=serializer_class.Meta.model
+        plan=Plan.from_serializer(serializer_class())
+        results.append({
+            'serializer': serializer_class.__name__,
+            'rows': model.objects.count(),
+            'slow': measure(serializer_class, model.objects.all()),
+            'view_mixin': measure(serializer_class, plan.apply(model.objects.all())),
+            'view_mixin_with_only_optim': measure(serializer_class, plan.apply(model.objects.all(), use_only=True)),
+        })
+    return results
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='auto_related benchmarks')
+    parser.add_argument('--rows', type=int, default=500, help='number of root rows of each fixture')
+    parser.add_argument('--fanout', type=int, default=5, help='fan-out of the relations in fixtures')
+    parser.add_argument('--widths', type=int, nargs='+', default=[1, 5, WIDTH])
+    parser.add_argument('--depths', type=int, nargs='+', default=list(range(1, DEPTH+1)))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--output', help='file to write json results, stdout if not given')
+    args=parser.parse_args(argv)
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    fixtures.parents(args.rows, args.fanout)
+    fixtures.courses(args.rows, args.fanout)
+    fixtures.levels(args.rows, args.fanout)
+
+    results={
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'djangorestframework': rest_framework.VERSION,
+        },
+        'parameters': vars(args),
+        'tracing': tracing(args.widths, args.depths, args.repeat, args.number),
+        'queries': queries([
+            tester_serializers.ParentSerializer,
+            tester_serializers.ChildChildSerializer2,
+            tester_serializers.TeacherSerializer,
+            tester_serializers.StudentSerializer,
+            tester_serializers.CourseSerializer2,
+            tester_serializers.CourseSerializerWithSuperTeacherSerializer,
+            level_serializer(WIDTH, DEPTH),
+        ]),
+    }
+
+    output=json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,29 @@
+from rest_framework.serializers import ModelSerializer
+
+from benchmarks.models import Tag, LEVELS, DEPTH, WIDTH
+
+
+class TagSerializer(ModelSerializer):
+    class Meta:
+        model = Tag
+        fields = '__all__'
+
+
+def level_serializer(width, depth, tags=True, level=0):
+    """
+    returns a serializer class for Level<level> with width text fields, nested serializers of 'up' relation
+    for depth levels and nested tags in every level if tags is True.
+    """
+    if not 0<width<=WIDTH or not 0<depth<=DEPTH-level:
+        raise ValueError('width should be in 1..{} and depth in 1..{}'.format(WIDTH, DEPTH-level))
+    model=LEVELS[level]
+    fields=['id']+['f{}'.format(i) for i in range(width)]
+    attrs={}
+    if depth>1:
+        attrs['up']=level_serializer(width, depth-1, tags, level+1)()
+        fields.append('up')
+    if tags:
+        attrs['tags']=TagSerializer(many=True)
+        fields.append('tags')
+    attrs['Meta']=type('Meta', (), {'model': model, 'fields': fields})
+    return type('Level{}Serializer_w{}_d{}'.format(level, width, depth), (ModelSerializer,), attrs)
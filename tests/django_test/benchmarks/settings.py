@@ -0,0 +1,28 @@
+"""
+Settings used by the benchmark suite. Database is an in memory sqlite database and
+there are no migrations for benchmark models, tables are created with run_syncdb.
+"""
+
+SECRET_KEY = 'benchmarks'
+
+DEBUG = False
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'rest_framework',
+    'auto_related',
+    'testerapp.apps.TesterappConfig',
+    'benchmarks.apps.BenchmarksConfig',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+USE_TZ = True
@@ -1,3 +1,5 @@
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
 # Create your models here.
@@ -19,13 +21,22 @@ class Teacher(models.Model):
     text=models.TextField()
     big_text_field=models.TextField(null=True)
     teaches=models.ManyToManyField('Course')
+    comments=GenericRelation('Comment')
 
 
 class Course(models.Model):
     text=models.TextField()
+    comments=GenericRelation('Comment')
 
 
 class Student(models.Model):
     text=models.TextField()
     courses=models.ManyToManyField('Course')
-    parent = models.OneToOneField(Parent, on_delete=models.SET_NULL, null=True)
\ No newline at end of file
+    parent = models.OneToOneField(Parent, on_delete=models.SET_NULL, null=True)
+
+
+class Comment(models.Model):
+    text=models.TextField()
+    content_type=models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id=models.PositiveIntegerField()
+    target=GenericForeignKey('content_type', 'object_id')
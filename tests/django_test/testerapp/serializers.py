@@ -1,3 +1,4 @@
+from django.db.models import Count
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 from testerapp.models import *
@@ -83,9 +84,9 @@ class CourseSerializer2(ModelSerializer):
 
 
 # a super teacher is a teacher who has more than 10 students
-# lets implement it with a method field
+# lets implement it with a method field. Its aggregate is annotated on the queryset so student sets are not loaded to be counted
 class IsSuperTeacherSerializer(ModelSerializer):
-    is_super_teacher= SerializerMethodField(sources=['teaches__student_set'])
+    is_super_teacher= SerializerMethodField(aggregate=Count('teaches__student'))
 
     def get_is_super_teacher(self, obj):
         return sum([course.student_set.count() for course in obj.teaches.all()])
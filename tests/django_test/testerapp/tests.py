@@ -1,3 +1,653 @@
+"""
+Regression tests of the planner. Run them from tests/django_test with the in memory settings of the benchmarks;
+
+    PYTHONPATH=../.. python manage.py test testerapp --settings=benchmarks.settings
+"""
+import json
+from base64 import urlsafe_b64encode
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import async_to_sync
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework import generics, pagination, serializers
+from rest_framework.test import APIRequestFactory
+
+from testerapp.models import *
+from testerapp.serializers import *
+from auto_related.asynchronous import AsyncListView
+from auto_related.cache import LocalRelationCache, relation_caches
+from auto_related.detector import NPlusOneDetectionMixin, NPlusOneError
+from auto_related.generic import GenericRelatedField
+from auto_related.instrumentation import QueryInstrumentationMiddleware
+from auto_related.mixin import PlanAwarePaginationMixin, StreamingViewMixin, ViewMixin, ViewMixinWithOnlyOptim
+from auto_related.pagination import KeysetPagination
+from auto_related.plan import Plan, plan_cache
+from auto_related.sparse import SparseFieldsSerializerMixin
+from auto_related.strategy import CostBasedJoinStrategy, JoinStrategy
+from auto_related.tracer import Tracer, optimized_queryset_given_trails
+from auto_related.utils import learned_sources
+from auto_related.values import ValuesSerializer, ValuesViewMixin
+
+
+class StudentCoursesSerializer(ModelSerializer):
+    courses=CourseSerializer(many=True)
+    class Meta:
+        model = Student
+        fields = ['id', 'courses']
+
+
+# reverse one to one relation which is joined, followed by a many to many relation
+class ParentStudentSerializer(ModelSerializer):
+    student=StudentCoursesSerializer()
+    class Meta:
+        model = Parent
+        fields = ['id', 'student']
+
+
+class TeacherTextSerializer(ModelSerializer):
+    class Meta:
+        model = Teacher
+        fields = ['id', 'text']
+
+
+# renders the whole teacher including a column that the nested serializer on the same relation does not read
+class TeacherField(serializers.RelatedField):
+    def to_representation(self, value):
+        return '{} {}'.format(value.text, len(value.big_text_field))
+
+
+class CourseTeachersSerializer(ModelSerializer):
+    teacher_set=TeacherTextSerializer(many=True)
+    teacher_names=TeacherField(many=True, read_only=True, source='teacher_set')
+    class Meta:
+        model = Course
+        fields = ['id', 'teacher_set', 'teacher_names']
+
+
+# relations accessed by a method cannot be traced
+class ParentMethodSerializer(ModelSerializer):
+    childchild_text=serializers.SerializerMethodField()
+    class Meta:
+        model = Parent
+        fields = ['id', 'childchild_text']
+
+    def get_childchild_text(self, obj):
+        return obj.child.child.text
+
+
+# fields added in get_fields() are seen only by tracing instances
+class DynamicParentSerializer(ModelSerializer):
+    class Meta:
+        model = Parent
+        fields = ['id', 'text']
+
+    def get_fields(self):
+        fields=super().get_fields()
+        if self.context.get('nested', True):
+            fields['child']=ChildSerializer()
+        return fields
+
+
+class SparseChildSerializer(SparseFieldsSerializerMixin, ModelSerializer):
+    child=ChildChildSerializer()
+    class Meta:
+        model = Child
+        fields = '__all__'
+
+
+class SparseParentSerializer(SparseFieldsSerializerMixin, ModelSerializer):
+    child=SparseChildSerializer()
+    class Meta:
+        model = Parent
+        fields = '__all__'
+
+
+# only the root drops unrequested fields, ChildSerializer renders all of its fields
+class SparseRootParentSerializer(SparseFieldsSerializerMixin, ModelSerializer):
+    child=ChildSerializer()
+    class Meta:
+        model = Parent
+        fields = '__all__'
+
+
+# generic foreign key whose targets are serialized by the serializers of their models
+class CommentSerializer(ModelSerializer):
+    target=GenericRelatedField({Course: CourseSerializer, Teacher: TeacherSerializer})
+    class Meta:
+        model = Comment
+        fields = ['id', 'text', 'target']
+
+
+class CommentTargetSerializer(ModelSerializer):
+    target=serializers.StringRelatedField()
+    class Meta:
+        model = Comment
+        fields = ['id', 'target']
+
+
+class CommentIdSerializer(ModelSerializer):
+    class Meta:
+        model = Comment
+        fields = ['id']
+
+
+class CourseCommentsSerializer(ModelSerializer):
+    comments=CommentIdSerializer(many=True)
+    class Meta:
+        model = Course
+        fields = ['id', 'text', 'comments']
+
+
+class AutoRelatedTestCase(TestCase):
+    """fixtures and helpers shared by the test cases below"""
+
+    @classmethod
+    def setUpTestData(cls):
+        childchilds=[ChildChild.objects.create(text='childchild {}'.format(i)) for i in range(3)]
+        children=[Child.objects.create(text='child {}'.format(i), child=childchilds[i%3]) for i in range(6)]
+        parents=[Parent.objects.create(text='parent {}'.format(i), child=children[i%6]) for i in range(10)]
+        courses=[Course.objects.create(text='course {}'.format(i)) for i in range(5)]
+        for i in range(8):
+            teacher=Teacher.objects.create(text='teacher {}'.format(i), big_text_field='x'*100)
+            teacher.teaches.set(courses[i%5:i%5+2])
+        for i in range(10):
+            student=Student.objects.create(text='student {}'.format(i), parent=parents[i])
+            student.courses.set(courses[i%5:i%5+3])
+
+
+    def setUp(self):
+        plan_cache.invalidate()
+        self.factory=APIRequestFactory()
+
+
+    def view(self, serializer_class, *mixins, **attrs):
+        attrs.setdefault('queryset', serializer_class.Meta.model.objects.order_by('pk'))
+        return type('View', mixins+(generics.ListAPIView,), dict(attrs, serializer_class=serializer_class))
+
+
+    def render(self, view_class, **params):
+        """returns (queries, data) of a GET request to the view"""
+        with CaptureQueriesContext(connection) as context:
+            response=view_class.as_view()(self.factory.get('/', params)).render()
+        return context.captured_queries, json.loads(response.content)
+
+
+    def assertInClausesBounded(self, queries, batch_size):
+        for query in queries:
+            if ' IN (' in query['sql']:
+                parameters=query['sql'].split(' IN (', 1)[1].split(')', 1)[0].split(',')
+                self.assertLessEqual(len(parameters), batch_size, query['sql'])
+
+
+class PlannerTestCase(AutoRelatedTestCase):
+    # number of queries of the traced plan for each serializer, with or without only()
+    expected_queries={
+        ParentSerializer: 1,
+        ChildChildSerializer2: 2,
+        TeacherSerializer: 2,
+        StudentSerializer: 2,
+        CourseSerializer2: 5,
+        IsSuperTeacherSerializer: 2,
+        CourseSerializerWithSuperTeacherSerializer: 3,
+    }
+
+    def test_plans_match_slow_path(self):
+        for serializer_class, expected in self.expected_queries.items():
+            _, slow=self.render(self.view(serializer_class))
+            for mixin in (ViewMixin, ViewMixinWithOnlyOptim):
+                with self.subTest(serializer=serializer_class.__name__, mixin=mixin.__name__):
+                    queries, data=self.render(self.view(serializer_class, mixin))
+                    self.assertEqual(data, slow)
+                    self.assertEqual(len(queries), expected)
+
+
+    def test_trie_keeps_deepest_paths(self):
+        # select_related('child__child') selects 'child' too and 'student_set__courses' prefetches 'student_set'
+        self.assertEqual(optimized_queryset_given_trails(Tracer(ParentSerializer()).trace()), ({'child__child'}, set()))
+        self.assertEqual(
+            optimized_queryset_given_trails(Tracer(CourseSerializer2()).trace()),
+            (set(), {'teacher_set__teaches', 'student_set__courses', 'student_set__parent__child__child'}),
+        )
+
+
+class OnlyTestCase(AutoRelatedTestCase):
+    def test_to_many_under_joined_relation(self):
+        self.assertEqual(optimized_queryset_given_trails(Tracer(ParentStudentSerializer()).trace()), ({'student'}, {'student__courses'}))
+        _, slow=self.render(self.view(ParentStudentSerializer))
+        queries, data=self.render(self.view(ParentStudentSerializer, ViewMixinWithOnlyOptim))
+        self.assertEqual(data, slow)
+        self.assertEqual(len(queries), 2)
+
+
+    def test_relation_rendered_whole_and_nested(self):
+        _, slow=self.render(self.view(CourseTeachersSerializer))
+        for from_class in (False, True):
+            with self.subTest(from_class=from_class):
+                plan_cache.invalidate()
+                queries, data=self.render(self.view(CourseTeachersSerializer, ViewMixinWithOnlyOptim, trace_from_class=from_class))
+                self.assertEqual(data, slow)
+                self.assertEqual(len(queries), 2)
+
+
+class BatchedPrefetchTestCase(AutoRelatedTestCase):
+    def test_prefetch_batches_bound_every_level(self):
+        _, slow=self.render(self.view(CourseSerializer2))
+        for mixin in (ViewMixin, ViewMixinWithOnlyOptim):
+            with self.subTest(mixin=mixin.__name__):
+                queries, data=self.render(self.view(CourseSerializer2, mixin, prefetch_batch_size=2))
+                self.assertEqual(data, slow)
+                self.assertInClausesBounded(queries, 2)
+                # courses in 3 batches and their relations in batches of their own
+                self.assertLess(len(queries), 30)
+
+
+    def test_streamed_chunks_are_batched(self):
+        _, slow=self.render(self.view(StudentSerializer))
+        view=self.view(StudentSerializer, StreamingViewMixin, ViewMixin, prefetch_batch_size=2, stream_chunk_size=5)
+        with CaptureQueriesContext(connection) as context:
+            response=view.as_view()(self.factory.get('/'))
+            data=json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data, slow)
+        self.assertInClausesBounded(context.captured_queries, 2)
+
+
+class InstrumentationTestCase(AutoRelatedTestCase):
+    def test_streamed_queries_are_recorded(self):
+        recorded=[]
+        view=self.view(StudentSerializer, StreamingViewMixin, ViewMixin, stream_chunk_size=5)
+        middleware=QueryInstrumentationMiddleware(view.as_view())
+        middleware.callback=recorded.append
+        with CaptureQueriesContext(connection) as context:
+            response=middleware(self.factory.get('/'))
+            self.assertEqual(recorded, [])
+            b''.join(response.streaming_content)
+        self.assertEqual(len(recorded), 1)
+        self.assertEqual(recorded[0].count, len(context.captured_queries))
+        # students and a prefetch of courses for each of the two chunks
+        self.assertEqual(recorded[0].count, 3)
+
+
+class DetectorTestCase(AutoRelatedTestCase):
+    def tearDown(self):
+        learned_sources.clear()
+
+
+    def test_raise(self):
+        self.render(self.view(ParentSerializer, NPlusOneDetectionMixin, ViewMixin, n_plus_one_mode='raise'))
+        with self.assertRaises(NPlusOneError) as context:
+            self.render(self.view(ParentMethodSerializer, NPlusOneDetectionMixin, ViewMixin, n_plus_one_mode='raise'))
+        self.assertEqual(context.exception.lazy_load.field_path, 'childchild_text')
+        self.assertEqual(context.exception.lazy_load.relation, 'Parent.child')
+
+
+    def test_learn_relations_of_methods(self):
+        _, slow=self.render(self.view(ParentMethodSerializer))
+        view=self.view(ParentMethodSerializer, NPlusOneDetectionMixin, ViewMixin, n_plus_one_mode='learn')
+        self.render(view)
+        self.assertEqual(learned_sources.get(ParentMethodSerializer), ['child', 'child.child'])
+        queries, data=self.render(view)
+        self.assertEqual(data, slow)
+        self.assertEqual(len(queries), 1)
+
+
+class PlanCacheTestCase(AutoRelatedTestCase):
+    def test_warmed_plans_match_slow_path(self):
+        plan_cache.warm(CourseSerializer2, StudentSerializer)
+        for serializer_class in (CourseSerializer2, StudentSerializer):
+            with self.subTest(serializer=serializer_class.__name__):
+                self.assertIn(serializer_class, plan_cache)
+                _, slow=self.render(self.view(serializer_class))
+                queries, data=self.render(self.view(serializer_class, ViewMixinWithOnlyOptim))
+                self.assertEqual(data, slow)
+                self.assertEqual(len(queries), PlannerTestCase.expected_queries[serializer_class])
+
+
+    def test_invalidated_plans_are_rebuilt(self):
+        view=self.view(ParentSerializer, ViewMixin)
+        _, slow=self.render(view)
+        self.assertIn(ParentSerializer, plan_cache)
+        plan_cache.invalidate(ParentSerializer)
+        self.assertNotIn(ParentSerializer, plan_cache)
+        queries, data=self.render(view)
+        self.assertEqual(data, slow)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(ParentSerializer, plan_cache)
+
+
+class ValuesTestCase(AutoRelatedTestCase):
+    def test_values_match_slow_path(self):
+        values_serializer=ValuesSerializer(ChildSerializer())
+        self.assertEqual(len(values_serializer.columns), len(set(values_serializer.columns)))
+        _, slow=self.render(self.view(ChildSerializer))
+        queries, data=self.render(self.view(ChildSerializer, ValuesViewMixin, ViewMixin))
+        self.assertEqual(data, slow)
+        self.assertEqual(len(queries), 1)
+
+
+    def test_values_cache_per_view_class(self):
+        child_view=self.view(ChildSerializer, ValuesViewMixin, ViewMixin, values_cache_size=1)
+        course_view=self.view(CourseSerializer, ValuesViewMixin, ViewMixin, values_cache_size=1)
+        self.render(child_view)
+        self.render(course_view)
+        self.assertEqual(len(child_view.get_values_cache()), 1)
+        self.assertEqual(len(course_view.get_values_cache()), 1)
+        self.assertIsNot(child_view.get_values_cache(), course_view.get_values_cache())
+
+
+class ClassTracingTestCase(AutoRelatedTestCase):
+    def test_class_plans_match_instance_plans(self):
+        for serializer_class in PlannerTestCase.expected_queries:
+            with self.subTest(serializer=serializer_class.__name__):
+                from_class=Plan.from_serializer(serializer_class, from_class=True)
+                from_instance=Plan.from_serializer(serializer_class())
+                for attribute in ('select', 'prefetch_paths', 'only', 'fill_paths'):
+                    self.assertEqual(getattr(from_class, attribute), getattr(from_instance, attribute))
+                self.assertEqual(set(from_class.annotations), set(from_instance.annotations))
+                _, slow=self.render(self.view(serializer_class))
+                queries, data=self.render(self.view(serializer_class, ViewMixinWithOnlyOptim, trace_from_class=True))
+                self.assertEqual(data, slow)
+                self.assertEqual(len(queries), PlannerTestCase.expected_queries[serializer_class])
+
+
+    def test_warmed_instance_plans(self):
+        _, slow=self.render(self.view(DynamicParentSerializer))
+        plan_cache.warm(DynamicParentSerializer)
+        plan_cache.warm(DynamicParentSerializer, from_class=True)
+        self.assertEqual(len(plan_cache), 2)
+        queries, data=self.render(self.view(DynamicParentSerializer, ViewMixinWithOnlyOptim))
+        self.assertEqual(data, slow)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(plan_cache), 2)
+
+
+    def test_warmed_context_plans(self):
+        class View(ViewMixinWithOnlyOptim, generics.ListAPIView):
+            serializer_class=DynamicParentSerializer
+            queryset=Parent.objects.order_by('pk')
+
+            def get_serializer_context(self):
+                return dict(super().get_serializer_context(), nested=False)
+
+            def get_plan_key(self):
+                return 'flat'
+
+        plan_cache.warm((DynamicParentSerializer(context={'nested': False}), 'flat'))
+        queries, data=self.render(View)
+        self.assertEqual(data[0], {'id': 1, 'text': 'parent 0'})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('testerapp_child', queries[0]['sql'])
+        self.assertEqual(len(plan_cache), 1)
+
+
+class AsyncTestCase(AutoRelatedTestCase):
+    def async_view(self, serializer_class, **attrs):
+        attrs.setdefault('queryset', serializer_class.Meta.model.objects.order_by('pk'))
+        return type('View', (AsyncListView,), dict(attrs, serializer_class=serializer_class))
+
+
+    def test_async_list_matches_slow_path(self):
+        async def get():
+            response=await view.as_view()(self.factory.get('/'))
+            return b''.join([part async for part in response.streaming_content])
+
+        _, slow=self.render(self.view(CourseSerializer2))
+        for batch_size in (None, 2):
+            with self.subTest(prefetch_batch_size=batch_size):
+                view=self.async_view(CourseSerializer2, stream_chunk_size=2, prefetch_batch_size=batch_size)
+                with CaptureQueriesContext(connection) as context:
+                    data=json.loads(async_to_sync(get)())
+                self.assertEqual(data, slow)
+                if batch_size is None:
+                    # courses and the prefetches of each of the three chunks
+                    self.assertEqual(len(context.captured_queries), 1+3*(PlannerTestCase.expected_queries[CourseSerializer2]-1))
+                else:
+                    self.assertInClausesBounded(context.captured_queries, batch_size)
+
+
+    def test_async_get_object(self):
+        async def get_object():
+            view=self.async_view(CourseSerializer2)()
+            view.request=None
+            return await view.aget_object(pk=course.pk)
+
+        course=Course.objects.get(text='course 2')
+        with CaptureQueriesContext(connection) as context:
+            obj=async_to_sync(get_object)()
+            data=CourseSerializer2(obj).data
+        self.assertEqual(data, CourseSerializer2(Course.objects.get(pk=course.pk)).data)
+        self.assertEqual(len(context.captured_queries), PlannerTestCase.expected_queries[CourseSerializer2])
+
+
+class StrategyTestCase(AutoRelatedTestCase):
+    def test_default_strategy_joins_to_one_relations(self):
+        plan=Plan.from_serializer(ParentSerializer(), strategy=JoinStrategy())
+        self.assertEqual(plan.select, ('child__child',))
+        self.assertEqual(plan.prefetch_paths, ())
+
+
+    def test_cost_based_strategy(self):
+        # (strategy, select, prefetch, queries)
+        strategies=(
+            (CostBasedJoinStrategy(max_join_depth=1), ('child',), ('child__child',), 2),
+            # small child table is read once instead of being repeated for every parent, its query joins childchild
+            (CostBasedJoinStrategy(table_stats={'testerapp.Parent': 100000, Child: 10, ChildChild: 5}), (), ('child__child',), 2),
+        )
+        _, slow=self.render(self.view(ParentSerializer))
+        for strategy, select, prefetch, expected in strategies:
+            with self.subTest(strategy=vars(strategy)):
+                plan=Plan.from_serializer(ParentSerializer(), strategy=strategy)
+                self.assertEqual(plan.select, select)
+                self.assertEqual(plan.prefetch_paths, prefetch)
+                for mixin in (ViewMixin, ViewMixinWithOnlyOptim):
+                    queries, data=self.render(self.view(ParentSerializer, mixin, plan_strategy=strategy))
+                    self.assertEqual(data, slow)
+                    self.assertEqual(len(queries), expected)
+
+
+class SparseFieldsTestCase(AutoRelatedTestCase):
+    def test_sparse_fields(self):
+        view=self.view(SparseParentSerializer, ViewMixinWithOnlyOptim, fields_param='fields')
+        queries, data=self.render(view, fields='id,child.text')
+        self.assertEqual(data[0], {'id': 1, 'child': {'text': 'child 0'}})
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('testerapp_childchild', queries[0]['sql'])
+
+
+    def test_sparse_fields_ignored_by_serializers_without_mixin(self):
+        for serializer_class, fields in ((ParentSerializer, 'id'), (SparseRootParentSerializer, 'id,child.text')):
+            with self.subTest(serializer=serializer_class.__name__):
+                _, slow=self.render(self.view(serializer_class), fields=fields)
+                queries, data=self.render(self.view(serializer_class, ViewMixinWithOnlyOptim, fields_param='fields'), fields=fields)
+                if serializer_class is ParentSerializer:
+                    self.assertEqual(data, slow)
+                else:
+                    self.assertEqual(data[0]['child'], slow[0]['child'])
+                self.assertEqual(len(queries), 1)
+
+
+    def test_one_plan_for_serializers_without_mixin(self):
+        view=self.view(ParentSerializer, ViewMixinWithOnlyOptim, fields_param='fields')
+        for fields in ('id', 'text', 'id,child.text'):
+            self.render(view, fields=fields)
+        self.assertEqual(len(plan_cache), 1)
+        self.assertIn(ParentSerializer, plan_cache)
+
+
+class PaginationTestCase(AutoRelatedTestCase):
+    def test_page_is_planned_alone(self):
+        class Pagination(pagination.CursorPagination):
+            page_size=3
+            ordering='-text'
+
+        paginations=((pagination.LimitOffsetPagination, {'limit': 3, 'offset': 2}), (Pagination, {}))
+        for pagination_class, params in paginations:
+            with self.subTest(pagination=pagination_class.__name__):
+                _, slow=self.render(self.view(CourseSerializer2, pagination_class=pagination_class), **params)
+                queries, data=self.render(self.view(CourseSerializer2, PlanAwarePaginationMixin, pagination_class=pagination_class), **params)
+                self.assertEqual(data, slow)
+                # count query of limit offset pagination and the page query run without the plan, then the plan is
+                # applied to the primary keys of the page
+                page=[i for i, query in enumerate(queries) if ' LIMIT ' in query['sql']]
+                self.assertEqual(len(page), 1)
+                self.assertNotIn(' JOIN ', queries[page[0]]['sql'])
+                hydrated=queries[page[0]+1:]
+                self.assertEqual(len(hydrated), PlannerTestCase.expected_queries[CourseSerializer2])
+                self.assertIn(' IN (', hydrated[0]['sql'])
+
+
+class KeysetPaginationTestCase(AutoRelatedTestCase):
+    def test_invalid_keyset_cursor(self):
+        class Pagination(KeysetPagination):
+            page_size=3
+            ordering=('text', '-id')
+
+        view=self.view(StudentSerializer, ViewMixin, pagination_class=Pagination)
+        for cursor in ('xx', '["abc"]', '["a", "abc"]', '["a", {"a": 1}]', '["a", null]'):
+            with self.subTest(cursor=cursor):
+                encoded=cursor if cursor=='xx' else urlsafe_b64encode(cursor.encode()).decode()
+                response=view.as_view()(self.factory.get('/', {'after': encoded}))
+                self.assertEqual(response.status_code, 404)
+
+
+    def test_keys_of_relations(self):
+        class Pagination(KeysetPagination):
+            page_size=3
+            ordering=('-child__text', 'id')
+
+        _, slow=self.render(self.view(ParentSerializer, queryset=Parent.objects.order_by('-child__text', 'id')))
+        for mixin in (ViewMixin, PlanAwarePaginationMixin):
+            with self.subTest(mixin=mixin.__name__):
+                view=self.view(ParentSerializer, mixin, pagination_class=Pagination)
+                results=[]
+                params={}
+                while True:
+                    _, data=self.render(view, **params)
+                    results+=data['results']
+                    if data['next'] is None:
+                        break
+                    params={'after': parse_qs(urlparse(data['next']).query)['after'][0]}
+                self.assertEqual(results, slow)
+
+
+class RelationCacheTestCase(AutoRelatedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache=relation_caches.register(ChildChild, LocalRelationCache())
+
+
+    def tearDown(self):
+        relation_caches.unregister(ChildChild)
+
+
+    def test_cached_relations_are_not_joined(self):
+        plan=Plan.from_serializer(ParentSerializer())
+        self.assertEqual(plan.select, ('child',))
+        self.assertEqual(plan.fill_paths, ('child__child',))
+
+
+    def test_relations_filled_from_cache(self):
+        # (serializer, queries of the first request, queries once childchilds are cached)
+        cases=(
+            (ParentSerializer, 2, 1),
+            # childchilds of the parents of the students of the courses are filled in the prefetch of students
+            (CourseSerializer2, PlannerTestCase.expected_queries[CourseSerializer2]+1, PlannerTestCase.expected_queries[CourseSerializer2]),
+        )
+        for serializer_class, first, cached in cases:
+            with self.subTest(serializer=serializer_class.__name__):
+                self.cache.clear()
+                _, slow=self.render(self.view(serializer_class))
+                for mixin in (ViewMixin, ViewMixinWithOnlyOptim):
+                    self.cache.clear()
+                    view=self.view(serializer_class, mixin)
+                    for expected in (first, cached):
+                        queries, data=self.render(view)
+                        self.assertEqual(data, slow)
+                        self.assertEqual(len(queries), expected)
+
+
+    def test_saved_and_deleted_instances_are_invalidated(self):
+        view=self.view(ParentSerializer, ViewMixin)
+        self.render(view)
+        childchild=ChildChild.objects.get(text='childchild 0')
+        self.assertIn(childchild.pk, self.cache.get_many(ChildChild, [childchild.pk]))
+        childchild.text='changed'
+        childchild.save()
+        self.assertEqual(self.cache.get_many(ChildChild, [childchild.pk]), {})
+        _, data=self.render(view)
+        self.assertEqual(data[0]['child']['child']['text'], 'changed')
+
+        unused=ChildChild.objects.create(text='unused')
+        self.cache.set_many(ChildChild, [unused])
+        pk=unused.pk
+        unused.delete()
+        self.assertEqual(self.cache.get_many(ChildChild, [pk]), {})
+
+
+class IdentityMapTestCase(AutoRelatedTestCase):
+    def test_identity_map_matches_slow_path(self):
+        _, slow=self.render(self.view(CourseSerializer2))
+        for mixin in (ViewMixin, ViewMixinWithOnlyOptim):
+            with self.subTest(mixin=mixin.__name__):
+                queries, data=self.render(self.view(CourseSerializer2, mixin, use_identity_map=True))
+                self.assertEqual(data, slow)
+                self.assertEqual(len(queries), PlannerTestCase.expected_queries[CourseSerializer2])
+
+
+    def test_rows_share_one_instance(self):
+        queryset=Plan.from_serializer(CourseSerializer2()).apply(Course.objects.order_by('pk'), identity_map=True)
+        courses={course.pk: course for course in queryset}
+        students={}
+        for course in courses.values():
+            for student in course.student_set.all():
+                self.assertIs(students.setdefault(student.pk, student), student)
+                # courses of a student are the instances of the queryset
+                for each in student.courses.all():
+                    self.assertIs(each, courses[each.pk])
+        # every student takes more than one course, hence it is reached more than once
+        self.assertEqual(len(students), Student.objects.count())
+
+
+class GenericRelationTestCase(AutoRelatedTestCase):
+    # number of queries of the traced plan for each serializer
+    expected_queries={
+        # comments, a query per content type and teaches of the teachers
+        CommentSerializer: 4,
+        CommentTargetSerializer: 3,
+        CourseCommentsSerializer: 2,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for target in list(Course.objects.order_by('pk'))+list(Teacher.objects.order_by('pk')[:4]):
+            Comment.objects.create(text='comment on {}'.format(target.text), target=target)
+
+
+    def test_plans_match_slow_path(self):
+        for serializer_class, expected in self.expected_queries.items():
+            _, slow=self.render(self.view(serializer_class))
+            for mixin in (ViewMixin, ViewMixinWithOnlyOptim):
+                for from_class in (False, True):
+                    with self.subTest(serializer=serializer_class.__name__, mixin=mixin.__name__, from_class=from_class):
+                        queries, data=self.render(self.view(serializer_class, mixin, trace_from_class=from_class))
+                        self.assertEqual(data, slow)
+                        self.assertEqual(len(queries), expected)
+
+
+    def test_targets_are_planned_for_their_serializers(self):
+        plan=Plan.from_serializer(CommentSerializer())
+        self.assertEqual(plan.prefetch_paths, ('target',))
+        self.assertEqual(type(plan.prefetch[0]).__name__, 'GenericPrefetch')
+        # generic foreign key is loaded from its columns
+        self.assertEqual(set(plan.only), {'id', 'text', 'content_type', 'object_id'})
+
 
-# Create your tests here.
+    def test_generic_relation_is_pruned(self):
+        queries, _=self.render(self.view(CourseCommentsSerializer, ViewMixinWithOnlyOptim))
+        # comments are matched to courses by their object id and content type columns
+        columns=queries[1]['sql'].split(' FROM ')[0]
+        for column in ('"id"', '"object_id"', '"content_type_id"'):
+            self.assertIn(column, columns)
+        self.assertNotIn('"text"', columns)